@@ -1,40 +1,29 @@
 import logging
+import multiprocessing
 
 import numpy as np
-from GPR import gpRegression
+from scipy.spatial import cKDTree
+from crossCovarianceCache import spatialCrossCovariance
+from GPR import expandLengthScales, gpFactorize, gpModel, gpPredict, gpPredictBlocks, gpRegression, gpRegressionBlocks
+from kroneckerGPR import kroneckerGpRegression
+from multiOutputGPR import multiOutputGpRegression
+from rollingGPR import loadRollingState, rollingGpRegression, saveRollingState
+from sparseGPR import inducingLattice, sparseGpRegression
+from stateSpaceGPR import stateSpaceGpRegression
+from taperedGPR import taperedGpRegression
 from utility_tools import longLat2Km  # longLat2Elevation
 
 # LOGGER = logging.getLogger(__name__)
 # LOGGER.setLevel(logging.INFO)
 
 
-def AQGPR(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, isTrain=False, isRegression=True):
+def AQGPR(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, isTrain=False, isRegression=True, calcVar=True, blockSize=None, optMethod='L-BFGS-B'):
     # LOGGER.info('logging in AQGPR')
     assert(isTrain or isRegression), "You should do either training, applying the regression or both!"
     assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
     if isRegression:
         assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
-    xQuery = np.matrix(xQuery)
-    x_tr = np.matrix(x_tr)
-    lat = xQuery[:, 0]
-    long = xQuery[:, 1]
-    time = xQuery[:, 2]
-    lat_tr = x_tr[:, 0]
-    long_tr = x_tr[:, 1]
-    time_tr = x_tr[:, 2]
-    longOrigin = long_tr.min()
-    latOrigin = lat_tr.min()
-    [xh_tr, xv_tr] = longLat2Km(long_tr, lat_tr, longOrigin, latOrigin)
-    [xh, xv] = longLat2Km(long, lat, longOrigin, latOrigin)
-
-#    elev_tr = longLat2Elevation(long_tr,lat_tr)
-#    elev = longLat2Elevation(long,lat)
-#    print elev_tr
-#    print elev
-#    xQuery = np.concatenate((xh, xv, elev, time),axis=1)
-#    x_tr = np.concatenate((xh_tr, xv_tr, elev_tr, time_tr),axis=1)
-    xQuery = np.concatenate((xh, xv, time), axis=1)
-    x_tr = np.concatenate((xh_tr, xv_tr, time_tr), axis=1)
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
 
 #    # Applying the model
     sigmaN = 5.81
@@ -49,18 +38,335 @@ def AQGPR(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=
         optSigmaF = True
         optL = True
         optSigmaN = False
-        [yPred, yVar, L, sigmaF, sigmaN] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression)
+        [yPred, yVar, L, sigmaF, sigmaN] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression, calcVar, blockSize, optMethod)
         return [yPred, yVar, L, sigmaF, sigmaN]
     elif isTrain:
         optSigmaF = True
         optL = True
         optSigmaN = False
-        [L, sigmaF, sigmaN] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression)
+        [L, sigmaF, sigmaN] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression, calcVar, blockSize, optMethod)
         return [L, sigmaF, sigmaN]
     else:
         optSigmaF = False
         optL = False
         optSigmaN = False
-        [yPred, yVar] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression)
+        [yPred, yVar] = gpRegression(x_tr,y_tr,xQuery,x_tr,y_tr,sigmaF0,optSigmaF,L0,optL,sigmaN,optSigmaN,basisFnDeg,isARD,isSpatIsot,learnRate,tol,maxIt,effOpt,center, isRegression, calcVar, blockSize, optMethod)
 
         return [yPred, yVar]
+
+
+# AQGPR of two query sets, the first one with a subset of the training points only (inSubset, e.g. the high uncertainty window within
+# the low uncertainty one) and the second one with all of them. The training points of the subset are put first, so the Cholesky
+# factor of their covariance is the leading block of the factor of the whole covariance and both models come from one factorization.
+# Both query sets use the projection of all the training points. Returns [[yPred, yVar] of xQuerySubset, [yPred, yVar] of xQuery]
+def AQNestedGPR(xQuerySubset, xQuery, x_tr, y_tr, inSubset, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, calcVar=True, blockSize=None):
+    assert(len(x_tr) == len(y_tr) and len(x_tr) == len(inSubset)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0]) and len(xQuerySubset[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    nQuerySubset = len(xQuerySubset)
+    [xQuery, x_tr] = projectCoordinates(np.concatenate((np.matrix(xQuerySubset), np.matrix(xQuery)), axis=0), x_tr)
+    inSubset = np.asarray(inSubset, dtype=bool)
+    order = np.concatenate((np.flatnonzero(inSubset), np.flatnonzero(~inSubset)))
+    x_tr = x_tr[order, :]
+    y_tr = np.matrix(y_tr)[order, :]
+    nSubset = np.sum(inSubset)
+
+    sigmaN = 5.81
+    isARD = True
+    isSpatIsot = True
+    center = True
+    L = expandLengthScales(L0, x_tr.shape[1], isARD, isSpatIsot)
+    model = gpFactorize(x_tr, y_tr, sigmaF0, L, sigmaN, basisFnDeg, 'Exp', center)
+    subsetModel = gpModel(x_tr[:nSubset, :], y_tr[:nSubset, :], model['cholK'][:nSubset, :nSubset], sigmaF0, L, basisFnDeg, 'Exp', center)
+
+    estimates = []
+    for [aModel, aQuery] in [[subsetModel, xQuery[:nQuerySubset, :]], [model, xQuery[nQuerySubset:, :]]]:
+        blocks = list(gpPredictBlocks(aModel, aQuery, blockSize, calcVar))
+        yPred = np.concatenate([block[0] for block in blocks], axis=0)
+        yVar = np.concatenate([block[1] for block in blocks], axis=0) if calcVar else None
+        estimates.append([yPred, yVar])
+    return estimates
+
+
+# AQGPR for several outputs measured at the training points, y_tr has one column per output and NaN where an output has no measurement.
+# hyperparameters holds [sigmaF0, L0, sigmaN] of every output, L0 is [space, time] like in AQGPR; sigmaN is given per output since
+# the fixed PM2.5 noise of AQGPR does not fit the other quantities. The outputs with the same hyperparameters and the same
+# measured points share one factorization, returns [yPred, yVar] with one column per output.
+def AQMultiOutputGPR(xQuery, x_tr, y_tr, hyperparameters, basisFnDeg=1, calcVar=True, blockSize=None):
+    assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
+
+    isARD = True
+    isSpatIsot = True
+    center = True
+    hyperparameters = [[sigmaF, expandLengthScales(L, x_tr.shape[1], isARD, isSpatIsot), sigmaN] for [sigmaF, L, sigmaN] in hyperparameters]
+    return multiOutputGpRegression(x_tr, y_tr, xQuery, hyperparameters, basisFnDeg, 'Exp', center, calcVar, blockSize)
+
+
+# Generator form of AQGPR (regression only): the training data is factorized once and [yPred, yVar] is yielded for every block of blockSize query points
+def AQGPRBlocks(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, blockSize=1000, calcVar=True):
+    assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
+
+    sigmaN = 5.81
+    isARD = True
+    isSpatIsot = True
+    center = True
+    for block in gpRegressionBlocks(x_tr, y_tr, xQuery, sigmaF0, L0, sigmaN, basisFnDeg, isARD, isSpatIsot, center, blockSize, calcVar):
+        yield block
+
+
+# Regression of AQGPR with the covariance tapered to zero beyond taperRange km (5 space lengths by default), solved with sparse matrices
+def AQTaperedGPR(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, taperRange=None, calcVar=True, blockSize=None):
+    assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
+
+    sigmaN = 5.81
+    L = [L0[0], L0[0], L0[1]]
+    center = True
+    if taperRange is None:
+        taperRange = 5.0 * L0[0]
+    return taperedGpRegression(x_tr, y_tr, xQuery, sigmaF0, L, sigmaN, basisFnDeg, taperRange, 'Exp', center, calcVar, blockSize)
+
+
+# Regression of AQGPR split into spatial tiles of the query points, each one solved only with the measurements of its neighborhood.
+# The training points of a tile are the ones within radiusFactor space lengths of the tile (at least minPoints of them), the tiles
+# overlap by one space length and their estimates are blended with the weights of tileWeight. Every tile fits its own mean function
+# (generalized least squares, like AQGPR), so its variance includes the uncertainty of the trend and a single tile covering all the
+# query points is AQGPR. The tiles are solved in parallel by nProcesses processes, serially inside a daemonic process (e.g. a worker
+# of the backfill pool) since it can not have children; tileSize is given in km (4 space lengths by default).
+def AQTiledGPR(xQuery, x_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, tileSize=None, radiusFactor=3.0, nProcesses=1, calcVar=True, blockSize=None, minPoints=50):
+    assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
+    xQuery = np.asarray(xQuery)
+    x_tr = np.asarray(x_tr)
+    y_tr = np.asarray(y_tr, dtype=float).reshape(-1, 1)
+
+    sigmaN = 5.81
+    Ls = L0[0]
+    if tileSize is None:
+        tileSize = 4.0 * Ls
+    overlap = Ls
+    tree = cKDTree(x_tr[:, :2])
+    origin = xQuery[:, :2].min(axis=0)
+    nTiles = np.floor((xQuery[:, :2].max(axis=0) - origin) / tileSize).astype(int) + 1
+
+    tasks = []
+    tileQueries = []
+    tileWeights = []
+    for i in range(nTiles[0]):
+        for j in range(nTiles[1]):
+            low = origin + tileSize * np.array([i, j])
+            high = low + tileSize
+            qIdx = np.flatnonzero(np.all((xQuery[:, :2] >= low - overlap) & (xQuery[:, :2] <= high + overlap), axis=1))
+            if len(qIdx) == 0:
+                continue
+            center = 0.5 * (low + high)
+            trIdx = set(tree.query_ball_point(center, np.sqrt(2) * (0.5 * tileSize + overlap) + radiusFactor * Ls))
+            if len(trIdx) < minPoints:
+                trIdx.update(np.atleast_1d(tree.query(center, k=min(minPoints, x_tr.shape[0]))[1]).tolist())
+            trIdx = sorted(trIdx)
+            tasks.append((x_tr[trIdx, :], y_tr[trIdx, :], xQuery[qIdx, :], sigmaF0, L0, sigmaN, basisFnDeg, calcVar, blockSize))
+            tileQueries.append(qIdx)
+            tileWeights.append(tileWeight(xQuery[qIdx, :2], low, high, overlap))
+
+    if nProcesses > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool(nProcesses)
+        try:
+            results = pool.map(tileRegression, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(tileRegression, tasks)
+
+    weightSum = np.zeros(xQuery.shape[0])
+    yPred = np.zeros(xQuery.shape[0])
+    yVar = np.zeros(xQuery.shape[0])
+    for qIdx, w, [yTile, varTile] in zip(tileQueries, tileWeights, results):
+        weightSum[qIdx] += w
+        yPred[qIdx] += w * np.asarray(yTile).ravel()
+        if calcVar:
+            yVar[qIdx] += w * np.asarray(varTile).ravel()
+
+    yPred = np.matrix(yPred / weightSum).T
+    if calcVar:
+        return [yPred, np.matrix(yVar / weightSum).T]
+    return [yPred, None]
+
+
+# Solves one tile of AQTiledGPR like AQGPR, the training and query points are already projected
+def tileRegression(task):
+    [x_tr, y_tr, xQuery, sigmaF, L0, sigmaN, basisFnDeg, calcVar, blockSize] = task
+    isARD = True
+    isSpatIsot = True
+    center = True
+    blocks = list(gpRegressionBlocks(np.matrix(x_tr), np.matrix(y_tr), np.matrix(xQuery), sigmaF, L0, sigmaN, basisFnDeg, isARD, isSpatIsot, center, blockSize, calcVar))
+    yPred = np.concatenate([block[0] for block in blocks], axis=0)
+    yVar = np.concatenate([block[1] for block in blocks], axis=0) if calcVar else None
+    return [yPred, yVar]
+
+
+# Blending weights of the query points of a tile: 0 at the outer border of its overlap, rising linearly to 0.5 at the border of the
+# tile and to 1 at one overlap inside it (the product of the weights of both coordinates)
+def tileWeight(xy, low, high, overlap):
+    if overlap <= 0:
+        return np.ones(xy.shape[0])
+    distance = np.minimum(xy - (low - overlap), (high + overlap) - xy)
+    return np.prod(np.clip(distance / (2.0 * overlap), 0, 1), axis=1)
+
+
+# Regression with an inducing point approximation (FITC or VFE) of AQGPR, for training sets too large for the exact solve
+# The inducing points are a lattice of inducingGrid = [nLat, nLong, nTime] points over the bounding box and the time span of the training points.
+def AQSparseGPR(xQuery, x_tr, y_tr, bottomLeftCorner, topRightCorner, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, inducingGrid=[10, 10, 4], method='FITC', calcVar=True, blockSize=None):
+    assert(len(x_tr) == len(y_tr)), "Number of the points in the independent variables must be equal to the number of the points in the measurments!"
+    assert(len(xQuery[0]) == len(x_tr[0])), "Dimension of the query data should be the same as the dimension of the data being used for regression."
+    time_tr = np.asarray(x_tr, dtype=float)[:, 2]
+    Z = inducingLattice(bottomLeftCorner, topRightCorner, time_tr.min(), time_tr.max(), inducingGrid[0], inducingGrid[1], inducingGrid[2])
+    [Z, x_km] = projectCoordinates(Z, x_tr)
+    [xQuery, x_tr] = projectCoordinates(xQuery, x_tr)
+
+    sigmaN = 5.81
+    L = [L0[0], L0[0], L0[1]]
+    center = True
+    return sparseGpRegression(x_tr, y_tr, xQuery, Z, sigmaF0, L, sigmaN, basisFnDeg, 'Exp', center, method, calcVar, blockSize)
+
+
+# AQGPR for a fixed mesh (grid version gridID) and a time x sensor measurement grid, with the spatial part of the cross covariance
+# between the mesh and the sensors read from the cache in cacheDir; only its time factor is calculated at every run.
+# The coordinates use the fixed projection of the mesh instead of the one of the training points.
+def AQCachedGPR(xQuery, lat_tr, long_tr, time_tr, y_tr, sensorIDs, gridID, cacheDir, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, calcVar=True, blockSize=None):
+    xQuery = np.asarray(xQuery, dtype=float)
+    y_tr = np.array(y_tr, dtype=float)
+    time_tr = np.asarray(time_tr, dtype=float).ravel()
+    assert(y_tr.shape == (len(time_tr), len(sensorIDs)) and len(lat_tr) == len(sensorIDs) and len(long_tr) == len(sensorIDs)), "The measurements should have a row for every time and a column for every sensor!"
+    assert(xQuery.shape[1] == 3), "The query points should be given as (lat, long, time)."
+
+    # a mesh with several query times repeats the points of the grid, the cache only holds each of them once (in the order of the mesh)
+    [first, meshIdx] = np.unique(xQuery[:, :2], axis=0, return_index=True, return_inverse=True)[1:]
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    meshPoints = xQuery[first[order], :2]
+    [Ks, meshKm, sensorKm] = spatialCrossCovariance(cacheDir, gridID, meshPoints[:, 0], meshPoints[:, 1], L0[0], sensorIDs, lat_tr, long_tr)
+    Ks = Ks[rank[meshIdx], :]
+    meshKm = meshKm[rank[meshIdx], :]
+
+    sigmaN = 5.81
+    isARD = True
+    isSpatIsot = True
+    center = True
+    L = expandLengthScales(L0, 3, isARD, isSpatIsot)
+    # observed cells of the grid, in time-major order
+    [tIdx, sIdx] = np.nonzero(~np.isnan(y_tr))
+    x_tr = np.column_stack((sensorKm[sIdx, :], time_tr[tIdx]))
+    model = gpFactorize(np.matrix(x_tr), np.matrix(y_tr[tIdx, sIdx]).T, sigmaF0, L, sigmaN, basisFnDeg, 'Exp', center)
+
+    xQuery = np.column_stack((meshKm, xQuery[:, 2]))
+    nQuery = xQuery.shape[0]
+    if blockSize is None:
+        blockSize = max(nQuery, 1)
+    blocks = []
+    for start in range(0, nQuery, blockSize):
+        end = min(start + blockSize, nQuery)
+        KStar = sigmaF0**2 * Ks[start:end, sIdx] * np.exp(-np.abs(xQuery[start:end, 2][:, np.newaxis] - time_tr[tIdx][np.newaxis, :]) / L[2])
+        blocks.append(gpPredict(model, np.matrix(xQuery[start:end, :]), calcVar, KStar))
+    yPred = np.concatenate([block[0] for block in blocks], axis=0)
+    yVar = np.concatenate([block[1] for block in blocks], axis=0) if calcVar else None
+    return [yPred, yVar]
+
+
+# Regression on the sensor x time grid with the Kronecker structured engine, gives the same estimates as AQGPR on the same data
+#
+# lat_tr, long_tr: the position of each of the S sensors
+# time_tr: the T relative times of the grid
+# y_tr: T x S measurements, NaN (or None) where a sensor has no measurement
+def AQKroneckerGPR(xQuery, lat_tr, long_tr, time_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, calcVar=True, blockSize=1000):
+    [xQuery, xs, time_tr, y_tr] = projectGrid(xQuery, lat_tr, long_tr, time_tr, y_tr)
+
+    sigmaN = 5.81
+    L = [L0[0], L0[0], L0[1]]
+    center = True
+    return kroneckerGpRegression(xs, time_tr, y_tr, xQuery, sigmaF0, L, sigmaN, basisFnDeg, 'Exp', center, calcVar, blockSize)
+
+
+# Regression on the sensor x time grid with the Kalman filter / RTS smoother engine, its cost grows linearly with the number of time bins.
+# Takes the same arguments as AQKroneckerGPR and gives the same estimates as AQGPR on the same data.
+def AQStateSpaceGPR(xQuery, lat_tr, long_tr, time_tr, y_tr, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, calcVar=True):
+    [xQuery, xs, time_tr, y_tr] = projectGrid(xQuery, lat_tr, long_tr, time_tr, y_tr)
+
+    sigmaN = 5.81
+    L = [L0[0], L0[0], L0[1]]
+    center = True
+    return stateSpaceGpRegression(xs, time_tr, y_tr, xQuery, sigmaF0, L, sigmaN, basisFnDeg, center, calcVar)
+
+
+# Regression on the sensor x time grid with the rolling window engine: the factorization of the previous run, kept in statePath,
+# is updated for the bins that left and entered the window instead of being recalculated.
+# binTimes and the query times are in hours since a fixed reference (the epoch), so that consecutive runs share their bins.
+# Returns [yPred, yVar, isIncremental]
+def AQRollingGPR(xQuery, lat_tr, long_tr, binTimes, y_tr, statePath, sigmaF0=10, L0=[4.3, 4.0], sigmaN=4.2, basisFnDeg=1, calcVar=True, blockSize=None):
+    assert(len(xQuery[0]) == 3), "The query points should be given as (lat, long, time)."
+
+    sigmaN = 5.81
+    L = [L0[0], L0[0], L0[1]]
+    center = True
+    state = loadRollingState(statePath)
+    [yPred, yVar, state, isIncremental] = rollingGpRegression(state, lat_tr, long_tr, binTimes, y_tr, xQuery, sigmaF0, L, sigmaN, basisFnDeg, 'Exp', center, calcVar, blockSize)
+    saveRollingState(statePath, state)
+    return [yPred, yVar, isIncremental]
+
+
+# Projects the query points and the sensors of a time x sensor measurement grid to km, returns [xQuery, xs, time_tr, y_tr]
+# Sensors without any measurement are dropped, and the projection uses the measured grid points exactly like AQGPR does with its training points.
+def projectGrid(xQuery, lat_tr, long_tr, time_tr, y_tr):
+    y_tr = np.array(y_tr, dtype=float)
+    nts = len(time_tr)
+    assert(y_tr.shape == (nts, len(lat_tr)) and len(lat_tr) == len(long_tr)), "The measurements should have a row for every time and a column for every sensor!"
+    assert(len(xQuery[0]) == 3), "The query points should be given as (lat, long, time)."
+
+    observed = ~np.isnan(y_tr)
+    hasData = observed.any(axis=0)
+    y_tr = y_tr[:, hasData]
+    observed = observed[:, hasData]
+    nSensors = y_tr.shape[1]
+    lat_tr = np.asarray(lat_tr, dtype=float)[hasData]
+    long_tr = np.asarray(long_tr, dtype=float)[hasData]
+    time_tr = np.asarray(time_tr, dtype=float).ravel()
+
+    x_tr = np.column_stack((np.tile(lat_tr, nts), np.tile(long_tr, nts), np.repeat(time_tr, nSensors)))
+    obsRows = np.flatnonzero(observed.ravel())
+    [xQuery, x_obs] = projectCoordinates(xQuery, x_tr[obsRows, :])
+    # every sensor takes its coordinates from its first measured grid point
+    firstRow = np.argmax(observed, axis=0) * nSensors + np.arange(nSensors)
+    xs = np.asarray(x_obs)[np.searchsorted(obsRows, firstRow), :2]
+    return [np.asarray(xQuery), xs, time_tr, y_tr]
+
+
+# Converts the (lat, long, time) columns of the query and the training points to (x km, y km, time), using the training points for the origin
+def projectCoordinates(xQuery, x_tr):
+    xQuery = np.matrix(xQuery)
+    x_tr = np.matrix(x_tr)
+    lat = xQuery[:, 0]
+    long = xQuery[:, 1]
+    time = xQuery[:, 2]
+    lat_tr = x_tr[:, 0]
+    long_tr = x_tr[:, 1]
+    time_tr = x_tr[:, 2]
+    longOrigin = long_tr.min()
+    latOrigin = lat_tr.min()
+    [xh_tr, xv_tr] = longLat2Km(long_tr, lat_tr, longOrigin, latOrigin)
+    [xh, xv] = longLat2Km(long, lat, longOrigin, latOrigin)
+
+#    elev_tr = longLat2Elevation(long_tr,lat_tr)
+#    elev = longLat2Elevation(long,lat)
+#    print elev_tr
+#    print elev
+#    xQuery = np.concatenate((xh, xv, elev, time),axis=1)
+#    x_tr = np.concatenate((xh_tr, xv_tr, elev_tr, time_tr),axis=1)
+    xQuery = np.concatenate((xh, xv, time), axis=1)
+    x_tr = np.concatenate((xh_tr, xv_tr, time_tr), axis=1)
+    return [xQuery, x_tr]
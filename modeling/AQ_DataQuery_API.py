@@ -1,17 +1,33 @@
+import calendar
 import csv
 import json
 import os
 import sys
+import threading
 
 from datetime import datetime
 from datetime import timedelta
-# import numpy as np
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from sensorMetadata import lastByID, sensorMetadata
 
 # from influxdb import InfluxDBClient
 
 
 TIMESTAMP = datetime.now().isoformat()
 
+# InfluxDB truncates the responses of more than max-row-limit rows (config/influxdb.conf) and only marks them as partial,
+# a grouped query returns one row per bin and sensor so its partitions are sized to stay under the limit
+MAX_ROWS_PER_QUERY = 10000
+
+# The quantities that can be queried with the PM2.5 (extraOutputs of AQDataQuery): their field in the airQuality measurement of Purple Air,
+# and the key of their measurement in dbs with its field for the airU sensors. An airU measurement that is not in dbs is not queried.
+EXTRA_OUTPUT_FIELDS = {'pm1': ['pm1.0 (ug/m^3)', 'airu_pm1_measurement', 'PM1'],
+                       'pm10': ['pm10.0 (ug/m^3)', 'airu_pm10_measurement', 'PM10'],
+                       'temperature': ['Temp (*C)', 'airu_temperature_measurement', 'Temperature'],
+                       'humidity': ['Humidity (%)', 'airu_humidity_measurement', 'Humidity']}
+
 
 def getConfig():
     with open(sys.path[0] + '/config/config.json', 'r') as configfile:
@@ -39,7 +55,13 @@ def generateDatePartitions(start, end, delta):
     return result
 
 
-def AQDataQuery(pAirClient, airUClient, dbs, startDate, endDate, binFreq=3600, maxLat=42.0013885498047, minLong=-114.053932189941, minLat=36.9979667663574, maxLong=-109.041069030762):
+# The independent queries (the sources of the discovery, and every partition of every source) run concurrently on nThreads threads,
+# with at most queriesPerSource queries of the same database at once. pAirClient and airUClient are functions that create a client of
+# their database, every thread creates its own one since a client (its requests session) is not thread safe; a client given as is
+# is shared by the threads and the queries of its database then run one at a time.
+# The names of extraOutputs (EXTRA_OUTPUT_FIELDS) are binned like the PM2.5 for the same sensors and bins, they are returned as the last
+# element {name: bins x sensors array}, and the Purple Air ones come with the PM2.5 in the same queries.
+def AQDataQuery(pAirClient, airUClient, dbs, startDate, endDate, binFreq=3600, maxLat=42.0013885498047, minLong=-114.053932189941, minLat=36.9979667663574, maxLong=-109.041069030762, nThreads=8, queriesPerSource=4, extraOutputs=[]):
     borderBox = {'left':   minLong,
                  'right':  maxLong,
                  'bottom': minLat,
@@ -69,160 +91,164 @@ def AQDataQuery(pAirClient, airUClient, dbs, startDate, endDate, binFreq=3600, m
     #     verify_ssl=True
     # )
 
-    # Creating the time stamps using the start date, end date, and the binning frequency
+    # Creating the time stamps using the start date, end date, and the binning frequency, the partitions end on bin boundaries
     tPartsNT = 500
-    datePartitions = generateDatePartitions(startDate, endDate, timedelta(seconds=tPartsNT * binFreq))
-
-    if len(datePartitions)>1:
-        nt = (len(datePartitions)-1)*500 + \
-        (datetime.strptime(datePartitions[-1],'%Y-%m-%dT%H:%M:%SZ')-\
-        datetime.strptime(datePartitions[-2],'%Y-%m-%dT%H:%M:%SZ')).total_seconds()/binFreq
-    else:
-        nt = (datetime.strptime(datePartitions[-1],'%Y-%m-%dT%H:%M:%SZ')-startDate).total_seconds()/binFreq
-    nt = int(nt)
+    startEpoch = calendar.timegm(startDate.utctimetuple())
+    endEpoch = calendar.timegm(endDate.utctimetuple())
+    firstBin = startEpoch - startEpoch % binFreq
 
     pAirUniqueIDs = []
     latitudes = []
     longitudes = []
     sensorModels = []
     airUUniqueIDs = []
-    initialDate = startDate.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-    for anEndDate in datePartitions:
-        # Querying the Purple Air sensor IDs with their coordinates and sensor model
-        result = pAirClient.query('SELECT "pm2.5 (ug/m^3)","ID","Longitude","Latitude","Sensor Model" FROM airQuality WHERE "Sensor Source" = \'Purple Air\' AND time >= \'' + initialDate + '\' AND time <= \'' + anEndDate + '\';')
-        result = list(result.get_points())
-
-        for row in result:
-            if row['Latitude'] is None or row['Longitude'] is None:
-                print("Skipped sensor with ID:" + row['ID'] + " -> Latitude/Longitude information not available!")
-                continue
-
-            if not((float(row['Longitude']) < borderBox['right']) and (float(row['Longitude']) > borderBox['left'])) or not((float(row['Latitude']) > borderBox['bottom']) and (float(row['Latitude']) < borderBox['top'])):
-                continue
-
-            if row['ID'] not in pAirUniqueIDs:
-                pAirUniqueIDs += [row['ID']]
-                latitudes += [float(row['Latitude'])]
-                longitudes += [float(row['Longitude'])]
-                if row['Sensor Model'] is None:
-                    sensorModels += ['PMS5003']
-                else:
-                    sensorModels += [row['Sensor Model'].split('+')[0]]
-
-        # Querying the airU sensor IDs with their coordinates and sensor model
-        result = airUClient.query('SELECT "PM2.5","ID","SensorModel" FROM ' + dbs['airu_pm25_measurement'] + ' WHERE time >= \'' + initialDate + '\' AND time <= \'' + anEndDate + '\';')
-        result = list(result.get_points())
-
-        # Querying the sensor IDs
-        tmpIDs = []
-        for row in result:
-            if row['ID'] not in tmpIDs and row['ID'] not in airUUniqueIDs:
-                tmpIDs += [row['ID']]
-
-        # Querying the coordinates and model of each sensor in the queried geographic area
-        for anID in tmpIDs:
-            last = airUClient.query('SELECT LAST(Latitude),"SensorModel" FROM ' +
-                                    dbs['airu_lat_measurement'] + ' WHERE ID=\'' + anID + '\' AND time >= \'' +
-                                    initialDate + '\' AND time <= \'' + anEndDate + '\';')
-            last = list(last.get_points())[0]
-            senModel = last['SensorModel']
-            lat = last['last']
-
-            last = airUClient.query('SELECT LAST(Longitude),"SensorModel" FROM ' +
-                                    dbs['airu_long_measurement'] + ' WHERE ID=\'' + anID + '\' AND time >= \'' +
-                                    initialDate + '\' AND time <= \'' + anEndDate + '\';')
-            last = list(last.get_points())[0]
-            long = last['last']
-
-            if lat is None or long is None:
-                print("Skipped sensor with ID:" + anID + " -> Latitude/Longitude information not available!")
-                continue
-            if lat == 0 or long == 0:
-                print("Skipped sensor with ID:" + anID + " -> Latitude/Longitude has not been aquired!")
-                continue
-
-            if not((float(long) < borderBox['right']) and (float(long) > borderBox['left'])) or not((float(lat) > borderBox['bottom']) and (float(lat) < borderBox['top'])):
-                continue
-
-            airUUniqueIDs += [anID]
-            latitudes += [float(lat)]
-            longitudes += [float(long)]
-            if senModel is None:
-                sensorModels += ['']
-            else:
-                sensorModels += [senModel.split('+')[0]]
-        initialDate = anEndDate
-
-    nres = 0
-    data = []
-    times = []
-    initialDate = startDate.strftime('%Y-%m-%dT%H:%M:%SZ')
-    for anEndDate in datePartitions:
-        for anID in pAirUniqueIDs:
-            # print 'SELECT * FROM airQuality WHERE "Sensor Source" = \'Purple Air\' AND time >= ' + initialDate + ' AND time <= ' + anEndDate + ';'
-            result = pAirClient.query('SELECT MEAN("pm2.5 (ug/m^3)") FROM airQuality WHERE "Sensor Source" = \'Purple Air\' AND time >= \'' + initialDate + '\' AND time < \'' + anEndDate + '\' AND ID = \'' + anID + '\' group by time(' + str(binFreq) + 's);')
-            result = list(result.get_points())
-
-            if anID == pAirUniqueIDs[0]:
-                if not result:
-                    for i in range(min(tPartsNT, nt-nres)):
-                        data.append([None])
-                    t = datetime.strptime(initialDate, '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                    et = datetime.strptime(anEndDate, '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                    while(t<et):
-                        times += [t]
-                        t += timedelta(seconds=binFreq)
-                else:
-                    for row in result:
-                        t = datetime.strptime(row['time'], '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                        times += [t]
-                        data.append([row['mean']])
-            else:
-                if not result:
-                    for i in range(min(tPartsNT, nt-nres)):
-                        data[i+nres] += [None]
-                else:
-                    for i in range(len(result)):
-                        data[i + nres] += [result[i]['mean']]
-
-        for anID in airUUniqueIDs:
-            # print 'SELECT * FROM airQuality WHERE "Sensor Source" = \'Purple Air\' AND time >= ' + initialDate + ' AND time <= ' + anEndDate + ';'
-            result = airUClient.query('SELECT MEAN("PM2.5") FROM ' +
-                                      dbs['airu_pm25_measurement'] + ' WHERE time >= \'' + initialDate + '\' ' +
-                                      'AND time < \'' + anEndDate + '\' AND ID = \'' + anID + '\' ' +
-                                      'group by time(' + str(binFreq) + 's);')
-            result = list(result.get_points())
-            if len(pAirUniqueIDs) == 0 and anID == airUUniqueIDs[0]:        # TODO does that line make sense
-                if not result:
-                    for i in range(min(tPartsNT, nt-nres)):
-                        data.append([None])
-                    t = datetime.strptime(initialDate, '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                    et = datetime.strptime(anEndDate, '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                    while(t<et):
-                        times += [t]
-                        t += timedelta(seconds=binFreq)
-                else:
-                    for idx, row in enumerate(result):
-                        t = datetime.strptime(row['time'], '%Y-%m-%dT%H:%M:%SZ') - timedelta(hours=7)
-                        times += [t]
-                        data.append([row['mean']])
-
-            else:
-                if not result:
-                    for i in range(min(tPartsNT, nt-nres)):
-                        data[i+nres] += [None]
-                else:
-                    for i in range(len(result)):
-                        rowMeanValue = result[i]['mean']
-                        data[i + nres] += [rowMeanValue]
-
-        initialDate = anEndDate
-        nres += tPartsNT
+    windowCondition = 'time >= \'' + startDate.strftime('%Y-%m-%dT%H:%M:%SZ') + '\' AND time <= \'' + endDate.strftime('%Y-%m-%dT%H:%M:%SZ') + '\''
+    pAirSource = querySource(pAirClient, queriesPerSource)
+    airUSource = querySource(airUClient, queriesPerSource)
+
+    # Querying the Purple Air sensor IDs with their coordinates and sensor model, one last row per sensor of the window,
+    # the airU sensor IDs that have data in the window, and the coordinates and model of all the airU sensors at once
+    [lastRows, airULastRows, metadata] = runConcurrently([
+        [pAirSource, lastByID, ('airQuality', 'pm2.5 (ug/m^3)', ['Longitude', 'Latitude', 'Sensor Model'], '"Sensor Source" = \'Purple Air\' AND ' + windowCondition)],
+        [airUSource, lastByID, (dbs['airu_pm25_measurement'], 'PM2.5', [], windowCondition)],
+        [airUSource, sensorMetadata, (dbs['airu_lat_measurement'], dbs['airu_long_measurement'], windowCondition)]], nThreads)
+
+    for anID in sorted(lastRows):
+        row = lastRows[anID]
+        if row['Latitude'] is None or row['Longitude'] is None:
+            print("Skipped sensor with ID:" + anID + " -> Latitude/Longitude information not available!")
+            continue
+
+        if not((float(row['Longitude']) < borderBox['right']) and (float(row['Longitude']) > borderBox['left'])) or not((float(row['Latitude']) > borderBox['bottom']) and (float(row['Latitude']) < borderBox['top'])):
+            continue
+
+        pAirUniqueIDs += [anID]
+        latitudes += [float(row['Latitude'])]
+        longitudes += [float(row['Longitude'])]
+        if row['Sensor Model'] is None:
+            sensorModels += ['PMS5003']
+        else:
+            sensorModels += [row['Sensor Model'].split('+')[0]]
+
+    # Keeping the airU sensors in the queried geographic area
+    for anID in sorted(airULastRows):
+        senModel = metadata.get(anID, {}).get('sensorModel')
+        lat = metadata.get(anID, {}).get('latitude')
+        long = metadata.get(anID, {}).get('longitude')
+
+        if lat is None or long is None:
+            print("Skipped sensor with ID:" + anID + " -> Latitude/Longitude information not available!")
+            continue
+        if lat == 0 or long == 0:
+            print("Skipped sensor with ID:" + anID + " -> Latitude/Longitude has not been aquired!")
+            continue
+
+        if not((float(long) < borderBox['right']) and (float(long) > borderBox['left'])) or not((float(lat) > borderBox['bottom']) and (float(lat) < borderBox['top'])):
+            continue
+
+        airUUniqueIDs += [anID]
+        latitudes += [float(lat)]
+        longitudes += [float(long)]
+        if senModel is None:
+            sensorModels += ['']
+        else:
+            sensorModels += [senModel.split('+')[0]]
 
     IDs = pAirUniqueIDs + airUUniqueIDs
+    groupByTime = ' GROUP BY time(' + str(binFreq) + 's), "ID" fill(null);'
+
+    # The bins of every output are preallocated as a time x sensor matrix, NaN where a sensor has no measurement. A bin is placed by its
+    # epoch time, its row is the number of bins since firstBin, the bin of InfluxDB (aligned to the epoch) that contains the start date.
+    nt = int((endEpoch - firstBin + binFreq - 1) // binFreq)
+    data = dict((output, np.full((nt, len(IDs)), np.nan)) for output in ['pm25'] + extraOutputs)
+    times = firstBin + binFreq * np.arange(nt, dtype=np.int64)
+    pAirColumns = dict((anID, j) for j, anID in enumerate(pAirUniqueIDs))
+    airUColumns = dict((anID, len(pAirUniqueIDs) + j) for j, anID in enumerate(airUUniqueIDs))
+
+    # One query per measurement for all the sensors of a partition, the series are split by their ID tag and the means are named by their
+    # output. A partition has at most tPartsNT bins, and fewer when the source has so many sensors that its response would pass
+    # MAX_ROWS_PER_QUERY rows (the rows do not depend on the number of fields).
+    pAirFields = [['pm2.5 (ug/m^3)', 'pm25']] + [[EXTRA_OUTPUT_FIELDS[output][0], output] for output in extraOutputs]
+    sources = [[pAirUniqueIDs, pAirSource, 'SELECT ' + meanFields(pAirFields) + ' FROM airQuality WHERE "Sensor Source" = \'Purple Air\' AND ', ['pm25'] + extraOutputs, pAirColumns],
+               [airUUniqueIDs, airUSource, 'SELECT ' + meanFields([['PM2.5', 'pm25']]) + ' FROM ' + dbs['airu_pm25_measurement'] + ' WHERE ', ['pm25'], airUColumns]]
+    for output in extraOutputs:
+        [pAirField, measurementKey, airUField] = EXTRA_OUTPUT_FIELDS[output]
+        if measurementKey in dbs:
+            sources.append([airUUniqueIDs, airUSource, 'SELECT ' + meanFields([[airUField, output]]) + ' FROM ' + dbs[measurementKey] + ' WHERE ', [output], airUColumns])
+    tasks = []
+    for [sourceIDs, source, selectQuery, outputs, sourceColumns] in sources:
+        if not sourceIDs:
+            continue
+        partitionNT = max(1, min(tPartsNT, MAX_ROWS_PER_QUERY // len(sourceIDs)))
+        initialDate = startDate.strftime('%Y-%m-%dT%H:%M:%SZ')
+        for anEndDate in generateDatePartitions(datetime.utcfromtimestamp(firstBin), endDate, timedelta(seconds=partitionNT * binFreq)):
+            tasks.append([source, binnedQuery, (selectQuery + 'time >= \'' + initialDate + '\' AND time < \'' + anEndDate + '\'' + groupByTime, outputs, sourceColumns, firstBin, binFreq, nt)])
+            initialDate = anEndDate
+
+    # The partitions do not share bins, the series are placed in the order of the tasks
+    for aResult in runConcurrently(tasks, nThreads):
+        for [column, rows, means] in aResult:
+            for output in means:
+                data[output][rows, column] = means[output]
+
+    return [data['pm25'], longitudes, latitudes, times, sensorModels, IDs, dict((output, data[output]) for output in extraOutputs)]
+
+
+# MEAN of every [field, output] named by its output, for the SELECT of a binned query
+def meanFields(fields):
+    return ', '.join('MEAN("' + field + '") AS "' + output + '"' for [field, output] in fields)
+
+
+# Runs a query grouped by time and "ID" (epoch times in seconds) with the means of outputs, returns [column, bin rows, {output: means}] of every
+# sensor of columns in it. A response truncated by the row limit of the server is an error, its missing sensors would otherwise look
+# like sensors without data.
+def binnedQuery(client, query, outputs, columns, firstBin, binFreq, nt):
+    result = client.query(query, epoch='s')
+    if result.raw.get('partial'):
+        raise RuntimeError('InfluxDB returned a partial response (max-row-limit) for: ' + query)
+    series = []
+    for (name, tags), points in result.items():
+        if tags['ID'] not in columns:
+            continue
+        points = list(points)
+        rows = (np.array([row['time'] for row in points], dtype=np.int64) - firstBin) // binFreq
+        inRange = (rows >= 0) & (rows < nt)
+        means = dict((output, np.array([row[output] for row in points], dtype=float)[inRange]) for output in outputs)
+        series.append([columns[tags['ID']], rows[inRange], means])
+    return series
+
+
+# Runs the tasks [source, function, args] on at most nThreads threads, function(client, *args) is called with the client of the source
+# of the current thread, holding the semaphore of the source while it runs. The results are in the order of the tasks.
+def runConcurrently(tasks, nThreads):
+    if nThreads <= 1 or len(tasks) <= 1:
+        return map(runLimited, tasks)
+    pool = ThreadPool(min(nThreads, len(tasks)))
+    try:
+        return pool.map(runLimited, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def runLimited(task):
+    [source, function, args] = task
+    with source['limit']:
+        return function(sourceClient(source), *args)
+
+
+# A database of AQDataQuery: newClient creates a client, at most queriesPerSource queries run at once (one when the client is shared)
+def querySource(client, queriesPerSource):
+    if callable(client):
+        return {'newClient': client, 'limit': threading.BoundedSemaphore(queriesPerSource), 'clients': threading.local()}
+    return {'newClient': lambda: client, 'limit': threading.BoundedSemaphore(1), 'clients': threading.local()}
+
 
-    return [data, longitudes, latitudes, times, sensorModels, IDs]
+# Client of the source for the current thread, created at its first query
+def sourceClient(source):
+    if not hasattr(source['clients'], 'client'):
+        source['clients'].client = source['newClient']()
+    return source['clients'].client
 
 
 if __name__ == "__main__":
@@ -293,6 +319,6 @@ if __name__ == "__main__":
     writeLoggingDataToFile(sum([['time'], ['Longitude'], longitudes], []))
 
     for ind, row in enumerate(pm25):
-        writeLoggingDataToFile(sum([[times[ind].strftime('%Y-%m-%dT%H:%M:%SZ')], [''], row], []))
+        writeLoggingDataToFile(sum([[datetime.utcfromtimestamp(times[ind]).strftime('%Y-%m-%dT%H:%M:%SZ')], [''], row.tolist()], []))
 
     print('DONE')
@@ -1,18 +1,19 @@
 import logging
 
 import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
 # import matplotlib.pyplot as pl
 # from NegLLGradient import gradLOONLL
-from negativeLogLikelihood import marginalNegLL  # looNegLL
+from negativeLogLikelihood import marginalNegLL, trainingContext  # looNegLL
 from NegLLGradient import gradMNLL
-from gradDescent import gradDescent
-from utility_tools import kerFunc, basisTerms, nchoosek
+from hyperparameterOptimization import optimizeHyperparameters
+from utility_tools import basisMatrix, jitterCholesky, kernelMatrix
 
-# LOGGER = logging.getLogger(__name__)
+LOGGER = logging.getLogger(__name__)
 # LOGGER.setLevel(logging.INFO)
 
 
-def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, optSigmaN, basisFnDeg, isARD, isSpatIsot, learnRate, tol, maxIt, effOpt, center, doRegression):
+def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, optSigmaN, basisFnDeg, isARD, isSpatIsot, learnRate, tol, maxIt, effOpt, center, doRegression, calcVar=True, blockSize=None, optMethod='L-BFGS-B'):
     # assert(y.shape[0]>=y.shape[1]),'The observed values shold be in a column vector'
     assert(x.shape[0] >= x.shape[1]), 'The independent variables should be in the columns, and the observations in the rows'
     # assert(y_tr.shape[0]>=y_tr.shape[1]),'The observed values shold be in a column vector'
@@ -20,27 +21,14 @@ def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, o
     assert(xQuery.shape[0] >= xQuery.shape[1]), 'The independent variables should be in the columns, and the tests in the rows'
 
     kerType = 'Exp'
+    L = expandLengthScales(L, x.shape[1], isARD, isSpatIsot)
     nL = len(L)
-    # conditioning related to ARD mode and/or spatially isotropic case
-    if isARD:
-        if isSpatIsot:
-            assert(nL == x.shape[1] - 1), 'The number of length scales should be the same as the independent variables minus 1 in spatially isotropic ARD mode'
-            L = [L[0], L[0]] + L[1:]
-            nL = len(L)
-        else:
-            assert(nL == x.shape[1]), 'The number of length scales should be the same as the independent variables in ARD mode'
-    else:
-        assert(nL == 1), 'If the mode is not ARD you just need one length scale for all the independent variables'
 
     # data preprocessing
-    nObs = x.shape[0]
-    nQuery = xQuery.shape[0]
     if basisFnDeg < 0:
-        yMean = np.mean(y)
         yMean_tr = np.mean(y_tr, 0)
         if (center):
             y_tr = y_tr - np.matrix(np.ones((y_tr.shape[0], 1))) * yMean_tr
-            y = y - yMean
 
     # Model Selection
 #    if (optL or optSigmaF or optSigmaN):
@@ -98,12 +86,25 @@ def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, o
               (optSigmaF and optSigmaN) * ' and ' + optSigmaN * 'sigmaN' + '...'
 
         theta0 = L + [sigmaF, sigmaN]
+        optList = [optL] * nL + [optSigmaF, optSigmaN]
         # logFun = lambda theta: looNegLL(x_tr,y_tr,theta[0:nL],theta[nL],theta[nL+1],effOpt,basisFnDeg,isARD,isSpatIsot)
-        logNgradLogFun = lambda theta: marginalNegLL(x_tr, y_tr, theta[0:nL], theta[nL], theta[nL + 1], optL, optSigmaF, optSigmaN, basisFnDeg, isARD, isSpatIsot, kerType, True)
-        # using gradient descent
+        # the coordinate differences and the basis matrix of the training set are computed once for all the iterations
+        context = trainingContext(x_tr, basisFnDeg)
+        logNgradLogFun = lambda theta: marginalNegLL(x_tr, y_tr, theta[0:nL], theta[nL], theta[nL + 1], optL, optSigmaF, optSigmaN, basisFnDeg, isARD, isSpatIsot, kerType, True, context)
+        if isARD and isSpatIsot:
+            # the two spatial length scales are tied, the optimizer only sees the first one
+            tiedLogNgradLogFun = logNgradLogFun
+            logNgradLogFun = lambda thetaC: untieGradient(tiedLogNgradLogFun([thetaC[0]] + list(thetaC)))
+            theta0 = theta0[1:]
+            optList = optList[1:]
         # gradLogFun = lambda theta: gradLOONLL(x_tr,y_tr,theta[0:nL],theta[nL],theta[nL+1],optL,optSigmaF,optSigmaN,basisFnDeg,isARD,isSpatIsot)
         #gradLogFun = lambda theta: gradMNLL(x, y, theta[0:nL], theta[nL], theta[nL + 1], optL, optSigmaF, optSigmaN, basisFnDeg, isARD, isSpatIsot)
-        theta = gradDescent(logNgradLogFun, theta0, [optL] * nL + [optSigmaF, optSigmaN], tol, learnRate, maxIt, True)
+        [theta, report] = optimizeHyperparameters(logNgradLogFun, theta0, optList, optMethod, tol, maxIt, learnRate)
+        if isARD and isSpatIsot:
+            theta = [theta[0]] + list(theta)
+        LOGGER.info('Optimization with ' + report['method'] + (' converged' if report['converged'] else ' did not converge') +
+                    ' after ' + str(report['nIt']) + ' iterations and ' + str(report['nFev']) + ' likelihood evaluations (' +
+                    report['message'] + '), objective = ' + str(report['objective']))
         # using SGD
         # gradLogFun = lambda theta,x,y: gradLOONLL(x,y,theta[0:nL],theta[nL],theta[nL+1],optL,optSigmaF,optSigmaN,isARD,isSpatIsot)
         # gradLogFun = lambda theta,x,y: gradMNLL(x,y,theta[0:nL],theta[nL],theta[nL+1],optL,optSigmaF,optSigmaN,isARD,isSpatIsot)
@@ -118,54 +119,10 @@ def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, o
     if doRegression:
         # print 'Applying the regression model...'
         # LOGGER.info('Applying the regression model...')
-        K = np.matrix(np.zeros((nObs, nObs)))
-        KStar = np.matrix(np.zeros((nQuery, nObs)))
-        Kss = np.matrix(np.zeros((nQuery, 1)))
-        delta = np.matrix(np.identity(nObs))
-        if basisFnDeg >= 0:
-            nIvar = x.shape[1]
-            nBasis = int(nchoosek(basisFnDeg + nIvar, basisFnDeg))
-            H = np.matrix(np.zeros((nBasis, nObs)))
-            HStar = np.matrix(np.zeros((nBasis, nQuery)))
-
-        for i in range(nObs):
-            for j in range(nObs):
-                K[i, j] = kerFunc(x[i, :], x[j, :], sigmaF, L, kerType) + sigmaN**2 * delta[i, j]
-            for j in range(nQuery):
-                KStar[j, i] = kerFunc(xQuery[j, :], x[i, :], sigmaF, L, kerType)
-            if basisFnDeg >= 0:
-                H[:, i] = basisTerms(x[i, :], basisFnDeg, 1, [])
-
-        for i in range(nQuery):
-            Kss[i, 0] = kerFunc(xQuery[i, :], xQuery[i, :], sigmaF, L, kerType)  # + sigmaN^2;
-
-            if basisFnDeg >= 0:
-                HStar[:, i] = basisTerms(xQuery[i, :], basisFnDeg, 1, [])
-
-        invK = K.I
-        invKy = invK * y
-        yPred = KStar * invKy
-        invKKsTr = invK * KStar.T
-        if basisFnDeg < 0:
-            if center:
-                yPred = yPred + yMean
-        else:
-            invKH = invK * H.T
-            R = HStar - H * invKKsTr
-            Beta = (H * invKH).I * (H * invKy)
-            yPred = yPred + R.T * Beta
-            tmpTerm = (H * invKH).I * R
-
-        yVar = np.matrix(np.zeros((nQuery, 1)))
-        for i in range(nQuery):
-            yVar[i, 0] = Kss[i, 0] - KStar[i, :] * invKKsTr[:, i]
-        # yVar = Kss - (KStar * invKKsTr).diagonal()
-
-        if basisFnDeg >= 0:
-            for i in range(nQuery):
-                yVar[i, 0] = yVar[i, 0] + R[:, i].T * tmpTerm[:, i]
-
-            # yVar = yVar + (R.T*((H*invKH).I * R)).diagonal()
+        model = gpFactorize(x, y, sigmaF, L, sigmaN, basisFnDeg, kerType, center)
+        blocks = list(gpPredictBlocks(model, xQuery, blockSize, calcVar))
+        yPred = np.concatenate([block[0] for block in blocks], axis=0)
+        yVar = np.concatenate([block[1] for block in blocks], axis=0) if calcVar else None
 
         # print "The program terminates after closing the plots..."
         # pl.show()
@@ -178,3 +135,108 @@ def gpRegression(x, y, xQuery, x_tr, y_tr, sigmaF, optSigmaF, L, optL, sigmaN, o
     else:
         print "You should do either training, applying the regression or both, otherwise the Gussian Processing Regression does nothing..!"
         return -1
+
+
+# Drops the gradient entry of the second (tied) spatial length scale, the first entry already is the derivative with respect to the shared length scale
+def untieGradient(objNgrad):
+    return objNgrad[0], np.delete(objNgrad[1], 1, 0)
+
+
+# Factorizes the covariance of the training data once, the returned model is shared by the predictions of all the query blocks
+def gpFactorize(x, y, sigmaF, L, sigmaN, basisFnDeg, kerType='Exp', center=True):
+    nObs = x.shape[0]
+    K = np.matrix(kernelMatrix(x, x, sigmaF, L, kerType)) + sigmaN**2 * np.matrix(np.identity(nObs))
+    # K = cholK * cholK.T, the inverse of K is never formed explicitly
+    cholK = jitterCholesky(K)
+    del K
+    return gpModel(x, y, cholK, sigmaF, L, basisFnDeg, kerType, center)
+
+
+# Model of gpFactorize from an already available lower Cholesky factor of the training covariance (sigmaN included)
+# y can have several columns, the predictions then have one column per output and the variance (which does not depend on y) is shared
+def gpModel(x, y, cholK, sigmaF, L, basisFnDeg, kerType='Exp', center=True):
+    model = {'x': x, 'sigmaF': sigmaF, 'L': L, 'kerType': kerType, 'basisFnDeg': basisFnDeg, 'yMean': 0.0}
+    if basisFnDeg < 0 and center:
+        # one mean per column, y can hold several outputs that share the factorization
+        model['yMean'] = np.mean(y, 0)
+        y = y - model['yMean']
+
+    invKy = np.matrix(cho_solve((cholK, True), y))
+    model['cholK'] = cholK
+    if basisFnDeg < 0:
+        model['alpha'] = invKy
+    else:
+        H = basisMatrix(x, basisFnDeg)
+        # W.T * W = H * K^-1 * H.T
+        W = np.matrix(solve_triangular(cholK, H.T, lower=True))
+        cholA = jitterCholesky(W.T * W)
+        Beta = np.matrix(cho_solve((cholA, True), H * invKy))
+        invKH = np.matrix(solve_triangular(cholK.T, W, lower=False))
+        # KStar * alpha + HStar.T * Beta is equal to KStar * invKy + R.T * Beta with R = HStar - H * K^-1 * KStar.T
+        model['alpha'] = invKy - invKH * Beta
+        model['Beta'] = Beta
+        model['W'] = W
+        model['cholA'] = cholA
+    return model
+
+
+# Posterior mean and variance of the query points using a model from gpFactorize
+# KStar, the covariance between the query points and the training points, is calculated unless it is given
+def gpPredict(model, xQuery, calcVar=True, KStar=None):
+    nQuery = xQuery.shape[0]
+    basisFnDeg = model['basisFnDeg']
+    if KStar is None:
+        KStar = kernelMatrix(xQuery, model['x'], model['sigmaF'], model['L'], model['kerType'])
+    KStar = np.matrix(KStar)
+    yPred = KStar * model['alpha'] + model['yMean']
+    if basisFnDeg >= 0:
+        HStar = basisMatrix(xQuery, basisFnDeg)
+        yPred = yPred + HStar.T * model['Beta']
+
+    if calcVar:
+        # the kernels are stationary, so the prior variance of every query point is sigmaF^2
+        Kss = model['sigmaF']**2 * np.matrix(np.ones((nQuery, 1)))  # + sigmaN^2;
+        # only the diagonal of the posterior covariance is calculated, as column sums of the solved blocks
+        # V.T * V = KStar * K^-1 * KStar.T
+        V = solve_triangular(model['cholK'], np.asarray(KStar.T), lower=True)
+        yVar = Kss - np.matrix(np.sum(V**2, 0)).T
+        if basisFnDeg >= 0:
+            R = np.asarray(HStar) - np.asarray(model['W'].T).dot(V)
+            # U.T * U = R.T * (H * K^-1 * H.T)^-1 * R
+            U = solve_triangular(model['cholA'], R, lower=True)
+            yVar = yVar + np.matrix(np.sum(U**2, 0)).T
+    else:
+        yVar = None
+    return [yPred, yVar]
+
+
+# Yields [yPred, yVar] for consecutive blocks of at most blockSize query points, so only one block of KStar is in memory at a time
+def gpPredictBlocks(model, xQuery, blockSize=None, calcVar=True):
+    nQuery = xQuery.shape[0]
+    if blockSize is None or blockSize <= 0:
+        blockSize = max(nQuery, 1)
+    for start in range(0, nQuery, blockSize):
+        yield gpPredict(model, xQuery[start:start + blockSize, :], calcVar)
+
+
+# Regression only version of gpRegression that yields the estimates block by block
+def gpRegressionBlocks(x, y, xQuery, sigmaF, L, sigmaN, basisFnDeg, isARD, isSpatIsot, center, blockSize, calcVar=True, kerType='Exp'):
+    assert(x.shape[0] >= x.shape[1]), 'The independent variables should be in the columns, and the observations in the rows'
+    L = expandLengthScales(L, x.shape[1], isARD, isSpatIsot)
+    model = gpFactorize(x, y, sigmaF, L, sigmaN, basisFnDeg, kerType, center)
+    for block in gpPredictBlocks(model, xQuery, blockSize, calcVar):
+        yield block
+
+
+# conditioning related to ARD mode and/or spatially isotropic case, returns one length scale per kernel dimension
+def expandLengthScales(L, nIvar, isARD, isSpatIsot):
+    nL = len(L)
+    if isARD:
+        if isSpatIsot:
+            assert(nL == nIvar - 1), 'The number of length scales should be the same as the independent variables minus 1 in spatially isotropic ARD mode'
+            L = [L[0], L[0]] + list(L[1:])
+        else:
+            assert(nL == nIvar), 'The number of length scales should be the same as the independent variables in ARD mode'
+    else:
+        assert(nL == 1), 'If the mode is not ARD you just need one length scale for all the independent variables'
+    return L
@@ -0,0 +1,63 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+from AQ_API import AQGPR, AQSparseGPR
+
+
+# Benchmark of the inducing point approximation against the exact AQGPR estimates.
+# The dataset is a reproducible synthetic network over the Salt Lake valley: sensors at random positions in the bounding box,
+# measured every binFrequency seconds with a smooth space-time PM2.5 field, sensor noise and missing measurements.
+def benchmarkDataset(nSensors, nBins, nQuery1D, bottomLeftCorner, topRightCorner, binFrequency=600, missing=0.1, seed=0):
+    rng = np.random.RandomState(seed)
+    lat = bottomLeftCorner['lat'] + (topRightCorner['lat'] - bottomLeftCorner['lat']) * rng.rand(nSensors)
+    lng = bottomLeftCorner['lng'] + (topRightCorner['lng'] - bottomLeftCorner['lng']) * rng.rand(nSensors)
+    times = np.arange(nBins) * binFrequency / 3600.0
+    lat_tr = np.tile(lat, nBins)
+    long_tr = np.tile(lng, nBins)
+    time_tr = np.repeat(times, nSensors)
+    pm25 = 15 + 8 * np.sin(25 * lat_tr + 0.3 * time_tr) * np.cos(18 * long_tr) + 2 * time_tr + 4 * rng.randn(nSensors * nBins)
+    keep = rng.rand(nSensors * nBins) > missing
+    x_tr = np.matrix(np.column_stack((lat_tr, long_tr, time_tr))[keep])
+    y_tr = np.matrix(pm25[keep]).T
+
+    qLat = np.linspace(bottomLeftCorner['lat'], topRightCorner['lat'], nQuery1D)
+    qLng = np.linspace(bottomLeftCorner['lng'], topRightCorner['lng'], nQuery1D)
+    [LNG, LAT] = np.meshgrid(qLng, qLat, indexing='ij')
+    xQuery = np.column_stack((LAT.ravel(), LNG.ravel(), np.repeat(times[-1], nQuery1D**2)))
+    return [np.matrix(xQuery), x_tr, y_tr]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Error and run time of the sparse GP approximations against the exact regression')
+    parser.add_argument('--sensors', type=int, default=150, help='number of sensors')
+    parser.add_argument('--bins', type=int, default=18, help='number of time bins')
+    parser.add_argument('--query', type=int, default=30, help='number of query points along each side of the mesh')
+    parser.add_argument('--inducing', type=int, nargs=3, default=[10, 10, 4], help='inducing lattice: lat, long and time points')
+    parser.add_argument('--space', type=float, default=2.0, help='characteristic space length (km)')
+    parser.add_argument('--time', type=float, default=1.0, help='characteristic time length (hours)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+
+    bottomLeftCorner = {'lat': 40.5, 'lng': -112.1}
+    topRightCorner = {'lat': 40.8, 'lng': -111.6}
+    [xQuery, x_tr, y_tr] = benchmarkDataset(args.sensors, args.bins, args.query, bottomLeftCorner, topRightCorner, seed=args.seed)
+    L0 = [args.space, args.time]
+    print 'training points: %d, query points: %d, inducing points: %d' % (x_tr.shape[0], xQuery.shape[0], np.prod(args.inducing))
+
+    start = time.time()
+    [yExact, varExact] = AQGPR(xQuery, x_tr, y_tr, L0=L0)
+    print '%-6s %8.2fs' % ('exact', time.time() - start)
+
+    for method in ['FITC', 'VFE']:
+        start = time.time()
+        [yPred, yVar] = AQSparseGPR(xQuery, x_tr, y_tr, bottomLeftCorner, topRightCorner, L0=L0, inducingGrid=args.inducing, method=method)
+        elapsed = time.time() - start
+        meanErr = np.asarray(yPred - yExact).ravel()
+        stdErr = np.sqrt(np.asarray(yVar).ravel()) - np.sqrt(np.asarray(varExact).ravel())
+        print '%-6s %8.2fs  mean RMSE %.3f (max %.3f)  std RMSE %.3f (max %.3f)' % (method, elapsed, np.sqrt(np.mean(meanErr**2)), np.abs(meanErr).max(), np.sqrt(np.mean(stdErr**2)), np.abs(stdErr).max())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 import argparse
+import calendar
 import json
 import logging
 import logging.handlers as handlers
@@ -11,14 +12,15 @@ import sys
 import time
 # import pytz
 
-from AQ_API import AQGPR
+from AQ_API import AQCachedGPR, AQGPR, AQKroneckerGPR, AQMultiOutputGPR, AQNestedGPR, AQRollingGPR, AQSparseGPR, AQStateSpaceGPR, AQTaperedGPR, AQTiledGPR
 from AQ_DataQuery_API import AQDataQuery
+from estimationCache import estimationFingerprint, loadCachedEstimate, storeCachedEstimate
 from datetime import datetime, timedelta
 from distutils.util import strtobool
 from influxdb import InfluxDBClient
 from pymongo import MongoClient
 # from StringIO import StringIO
-from utility_tools import calibrate, datetime2Reltime, findMissings, removeMissings
+from utility_tools import calibrate, datetime2Reltime, epoch2Reltime, findMissings, removeMissings
 
 
 LOGGER = logging.getLogger(__name__)
@@ -35,6 +37,22 @@ LOGGER.addHandler(logHandler)
 currentUTCtime = datetime.utcnow()
 # currentUTCtime_str = currentUTCtime.isoformat()
 
+# layers the 'multiOutput' mode can estimate with the PM2.5, queried as the extraOutputs of AQDataQuery. PM1 and PM10 have the hyperparameters
+# of the PM2.5 so that they share its factorization where they are measured at the same points, they are cleaned like the PM2.5 (findMissings)
+# and their levels follow the PM2.5 ones (AQI breakpoints); temperature (C) and humidity (%) have their own hyperparameters and levels.
+MULTI_OUTPUT_LAYERS = {'pm1': {'sigmaF': 10.0, 'sigmaN': 5.81, 'isPM': True,
+                               'levels': [0.0, 4.0, 8.0, 12.0, 19.8, 27.6, 35.4, 42.1, 48.7, 55.4, 150.4, 250.4],
+                               'colorBands': ('#31a354', '#a1d99b', '#e5f5e0', '#ffffcc', '#ffeda0', '#fed976', '#feb24c', '#fd8d3c', '#fc4e2a', '#e31a1c', '#bd0026', '#800026')},
+                       'pm10': {'sigmaF': 10.0, 'sigmaN': 5.81, 'isPM': True,
+                                'levels': [0.0, 18.0, 36.0, 54.0, 87.3, 120.7, 154.0, 187.3, 220.7, 254.0, 354.0, 424.0],
+                                'colorBands': ('#31a354', '#a1d99b', '#e5f5e0', '#ffffcc', '#ffeda0', '#fed976', '#feb24c', '#fd8d3c', '#fc4e2a', '#e31a1c', '#bd0026', '#800026')},
+                       'temperature': {'sigmaF': 8.0, 'sigmaN': 1.0, 'isPM': False,
+                                       'levels': [-30.0, -20.0, -10.0, -5.0, 0.0, 5.0, 10.0, 15.0, 20.0, 25.0, 30.0, 40.0],
+                                       'colorBands': ('#313695', '#4575b4', '#74add1', '#abd9e9', '#e0f3f8', '#ffffbf', '#fee090', '#fdae61', '#f46d43', '#d73027', '#a50026', '#800026')},
+                       'humidity': {'sigmaF': 20.0, 'sigmaN': 3.0, 'isPM': False,
+                                    'levels': [0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0, 80.0, 90.0, 95.0, 100.0],
+                                    'colorBands': ('#ffffe5', '#f7fcb9', '#d9f0a3', '#addd8e', '#78c679', '#41ab5d', '#238443', '#1d91c0', '#225ea8', '#253494', '#081d58', '#040c2c')}}
+
 
 # getting the config file
 def getConfig(aPath, fileName):
@@ -89,14 +107,30 @@ def generateQueryMeshVariableGrid(numberGridCellsLAT, numberGridCellsLONG, botto
     return {'lats': lats, 'lngs': lngs, 'times': times}
 
 
-def getEstimate(purpleAirClient, airuClient, theDBs, characteristicLength_space, characteristicLength_time, mesh, start, end, theBottomLeftCorner, theTopRightCorner, binFrequency):
+def getEstimate(purpleAirClient, airuClient, theDBs, characteristicLength_space, characteristicLength_time, mesh, start, end, theBottomLeftCorner, theTopRightCorner, binFrequency, blockSize=None, estimationMode='exact', inducingGrid=[10, 10, 4], sparseMethod='FITC', tileSize=None, tileRadiusFactor=3.0, tileProcesses=1, taperRange=None, rollingStatePath='rollingModel.npz', gridID=None, crossCovarianceCacheDir=None, extraOutputs=[]):
+
+    data_tr = getTrainingData(purpleAirClient, airuClient, theDBs, start, end, theBottomLeftCorner, theTopRightCorner, binFrequency, extraOutputs=[anOutput[0] for anOutput in extraOutputs])
+
+    return estimateFromData(data_tr, characteristicLength_space, characteristicLength_time, mesh, theBottomLeftCorner, theTopRightCorner, blockSize, estimationMode, inducingGrid, sparseMethod, tileSize, tileRadiusFactor, tileProcesses, taperRange, rollingStatePath, gridID, crossCovarianceCacheDir, extraOutputs)
+
+
+# data phase of getEstimate: the binned measurements of the area, [pm2p5, longs, lats, times, sensorModels, IDs, extras], pm2p5 is a bins x sensors
+# array (NaN when missing), times the epoch times in seconds of the bins and extras {name: bins x sensors array} of the extraOutputs names
+# the clients are given like in AQDataQuery, as functions that create them (one client per query thread) or as shared clients
+def getTrainingData(purpleAirClient, airuClient, theDBs, start, end, theBottomLeftCorner, theTopRightCorner, binFrequency, queryThreads=8, queriesPerSource=4, extraOutputs=[]):
 
     startDate = start
     endDate = end
 
     # for 4h characteristicLength => 3600 * 2
     # for 1/6h characteristicLength => 120
-    data_tr = AQDataQuery(purpleAirClient, airuClient, theDBs, startDate, endDate, binFrequency, theTopRightCorner['lat'], theBottomLeftCorner['lng'], theBottomLeftCorner['lat'], theTopRightCorner['lng'])
+    return AQDataQuery(purpleAirClient, airuClient, theDBs, startDate, endDate, binFrequency, theTopRightCorner['lat'], theBottomLeftCorner['lng'], theBottomLeftCorner['lat'], theTopRightCorner['lng'], queryThreads, queriesPerSource, extraOutputs)
+
+
+# estimation phase of getEstimate, from the output of getTrainingData
+# extraOutputs are the [name, sigmaF, sigmaN] of the layers the 'multiOutput' mode estimates with the PM2.5 (multiOutputLayers), their estimate
+# and variance are returned after the coordinates as nQuery x len(extraOutputs) matrices
+def estimateFromData(data_tr, characteristicLength_space, characteristicLength_time, mesh, theBottomLeftCorner, theTopRightCorner, blockSize=None, estimationMode='exact', inducingGrid=[10, 10, 4], sparseMethod='FITC', tileSize=None, tileRadiusFactor=3.0, tileProcesses=1, taperRange=None, rollingStatePath='rollingModel.npz', gridID=None, crossCovarianceCacheDir=None, extraOutputs=[]):
 
     pm2p5_tr = data_tr[0]
     long_tr = data_tr[1]
@@ -111,11 +145,6 @@ def getEstimate(purpleAirClient, airuClient, theDBs, characteristicLength_space,
     pm2p5_tr = findMissings(pm2p5_tr)
     pm2p5_tr = np.matrix(pm2p5_tr, dtype=float)
     pm2p5_tr = calibrate(pm2p5_tr, sensorModels)
-    pm2p5_tr = pm2p5_tr.flatten().T
-    lat_tr = np.tile(np.matrix(lat_tr).T, [nts, 1])
-    long_tr = np.tile(np.matrix(long_tr).T, [nts, 1])
-    time_tr = datetime2Reltime(time_tr, min(time_tr))
-    time_tr = np.repeat(np.matrix(time_tr).T, nLats, axis=0)
 
     # meshInfo = generateQueryMeshGrid(numberOfGridCells1D, topleftCorner, bottomRightCorner)
     # meshInfo = generateQueryMeshVariableGrid(numberGridCells_LAT, numberGridCells_LONG, bottomLeftCorner, topRightCorner, queryTimeRel)
@@ -125,15 +154,57 @@ def getEstimate(purpleAirClient, airuClient, theDBs, characteristicLength_space,
     lat_Q = np.matrix(meshInfo['lats'])
     time_Q = np.matrix(meshInfo['times'])
 
+    # This would be the xQuery of the AQGPR function
+    x_Q = np.concatenate((lat_Q, long_Q, time_Q), axis=1)
+
+    if estimationMode == 'kronecker':
+        # the measurements stay on their time x sensor grid, the missing ones are NaN
+        [yPred, yVar] = AQKroneckerGPR(x_Q.tolist(), lat_tr, long_tr, epoch2Reltime(time_tr, np.min(time_tr)), pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, blockSize=blockSize)
+        return [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]
+    elif estimationMode == 'stateSpace':
+        [yPred, yVar] = AQStateSpaceGPR(x_Q.tolist(), lat_tr, long_tr, epoch2Reltime(time_tr, np.min(time_tr)), pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1)
+        return [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]
+    elif estimationMode == 'rolling':
+        # the bins are placed in hours since the epoch, so that consecutive runs share them; the query times stay relative to the first bin
+        binTimes = epoch2Reltime(time_tr, 0)
+        xQuery = np.asarray(x_Q, dtype=float)
+        xQuery[:, 2] += min(binTimes)
+        [yPred, yVar, isIncremental] = AQRollingGPR(xQuery.tolist(), lat_tr, long_tr, binTimes, pm2p5_tr, rollingStatePath, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, blockSize=blockSize)
+        LOGGER.info('rolling window model %s', 'updated incrementally' if isIncremental else 'refactorized')
+        return [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]
+    elif estimationMode == 'exact' and crossCovarianceCacheDir is not None and gridID is not None:
+        # the spatial cross covariance between the mesh of the grid version and the sensors comes from the cache
+        [yPred, yVar] = AQCachedGPR(x_Q, lat_tr, long_tr, epoch2Reltime(time_tr, np.min(time_tr)), pm2p5_tr, data_tr[5], gridID, crossCovarianceCacheDir, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, blockSize=blockSize)
+        return [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]
+
+    pm2p5_tr = pm2p5_tr.flatten().T
+    lat_tr = np.tile(np.matrix(lat_tr).T, [nts, 1])
+    long_tr = np.tile(np.matrix(long_tr).T, [nts, 1])
+    time_tr = epoch2Reltime(time_tr, np.min(time_tr))
+    time_tr = np.repeat(np.matrix(time_tr).T, nLats, axis=0)
+
     # This would be y_tr of the AQGPR function
     # pm2p5_tr = np.matrix(pm25)
     # pm2p5_tr = pm25
 
     # This would be the x_tr of the AQGPR function
     x_tr = np.concatenate((lat_tr, long_tr, time_tr), axis=1)
+
+    if estimationMode == 'multiOutput':
+        # one column per layer on the same training points, a point is kept when any of the layers is measured at it. The PM2.5 has the
+        # hyperparameters of AQGPR (which fixes sigmaN to 5.81), the layers with the same ones and measured points share its factorization
+        Y_tr = [np.asarray(pm2p5_tr)]
+        hyperparameters = [[10, [characteristicLength_space, characteristicLength_time/3600.0], 5.81]]
+        for [name, sigmaF, sigmaN] in extraOutputs:
+            values = findMissings(data_tr[6][name]) if MULTI_OUTPUT_LAYERS[name]['isPM'] else np.array(data_tr[6][name], dtype=float)
+            Y_tr.append(values.reshape(-1, 1))
+            hyperparameters.append([sigmaF, [characteristicLength_space, characteristicLength_time/3600.0], sigmaN])
+        Y_tr = np.concatenate(Y_tr, axis=1)
+        measured = np.flatnonzero(~np.all(np.isnan(Y_tr), axis=1))
+        [yPred, yVar] = AQMultiOutputGPR(x_Q, x_tr[measured, :], Y_tr[measured, :], hyperparameters, basisFnDeg=1, blockSize=blockSize)
+        return [yPred[:, 0], yVar[:, 0], x_Q[:, 0], x_Q[:, 1], yPred[:, 1:], yVar[:, 1:]]
+
     x_tr, pm2p5_tr = removeMissings(x_tr, pm2p5_tr)
-    # This would be the xQuery of the AQGPR function
-    x_Q = np.concatenate((lat_Q, long_Q, time_Q), axis=1)
 
     # set parameters
     # we usually initialize sigmaF0 for training as the standard deviation of the sensor measurements
@@ -158,11 +229,135 @@ def getEstimate(purpleAirClient, airuClient, theDBs, characteristicLength_space,
 
     # the rest uses the default values given by Amir
     # [yPred, yVar] = AQGPR(x_Q, x_tr, pm2p5_tr)  # , sigmaF0, L0, sigmaN, basisFnDeg, isTrain, isRegression)
-    [yPred, yVar] = AQGPR(x_Q, x_tr, pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, isTrain=False, isRegression=True)
+    if estimationMode == 'sparse':
+        [yPred, yVar] = AQSparseGPR(x_Q, x_tr, pm2p5_tr, theBottomLeftCorner, theTopRightCorner, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, inducingGrid=inducingGrid, method=sparseMethod, blockSize=blockSize)
+    elif estimationMode == 'tiled':
+        [yPred, yVar] = AQTiledGPR(x_Q, x_tr, pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, tileSize=tileSize, radiusFactor=tileRadiusFactor, nProcesses=tileProcesses, blockSize=blockSize)
+    elif estimationMode == 'tapered':
+        [yPred, yVar] = AQTaperedGPR(x_Q, x_tr, pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, taperRange=taperRange, blockSize=blockSize)
+    else:
+        [yPred, yVar] = AQGPR(x_Q, x_tr, pm2p5_tr, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, isTrain=False, isRegression=True, blockSize=blockSize)
 
     return [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]
 
 
+# Functions that create an InfluxDB client of the PurpleAir and of the airU database, and the airU measurement names, [newPAirClient, newAirUClient, dbs].
+# AQDataQuery creates the clients of every one of its query threads with them
+def getInfluxClientFactories(config):
+
+    # PurpleAir client
+    newPAirClient = lambda: InfluxDBClient(
+        config['INFLUX_HOST'],
+        config['INFLUX_PORT'],
+        config['INFLUX_MODELLING_USERNAME'],
+        config['INFLUX_MODELLING_PASSWORD'],
+        config['PURPLE_AIR_DB'],
+        ssl=True,
+        verify_ssl=True
+    )
+
+    # airU client
+    newAirUClient = lambda: InfluxDBClient(
+        config['INFLUX_HOST'],
+        config['INFLUX_PORT'],
+        config['INFLUX_MODELLING_USERNAME'],
+        config['INFLUX_MODELLING_PASSWORD'],
+        config['AIRU_DB'],
+        ssl=True,
+        verify_ssl=True
+    )
+
+    dbs = {'airu_pm25_measurement': config['INFLUX_AIRU_PM25_MEASUREMENT'],
+           'airu_lat_measurement': config['INFLUX_AIRU_LATITUDE_MEASUREMENT'],
+           'airu_long_measurement': config['INFLUX_AIRU_LONGITUDE_MEASUREMENT']}
+
+    # the airU measurements of the other layers of the multiOutput mode are optional, the layers only come from Purple Air without them
+    for [key, configKey] in [['airu_pm1_measurement', 'INFLUX_AIRU_PM1_MEASUREMENT'], ['airu_pm10_measurement', 'INFLUX_AIRU_PM10_MEASUREMENT'],
+                             ['airu_temperature_measurement', 'INFLUX_AIRU_TEMPERATURE_MEASUREMENT'], ['airu_humidity_measurement', 'INFLUX_AIRU_HUMIDITY_MEASUREMENT']]:
+        if config.get(configKey):
+            dbs[key] = config[configKey]
+
+    return [newPAirClient, newAirUClient, dbs]
+
+
+# [name, sigmaF, sigmaN] of the layers estimated with the PM2.5 (the extraOutputs of estimateFromData), none unless the mode is 'multiOutput'.
+# multiOutputLayers of the config lists their names (all of MULTI_OUTPUT_LAYERS by default) and multiOutputHyperparameters can
+# replace the [sigmaF, sigmaN] of any of them
+def multiOutputLayers(modellingConfig):
+    if modellingConfig.get('estimationMode', 'exact') != 'multiOutput':
+        return []
+    names = modellingConfig.get('multiOutputLayers', ['pm1', 'pm10', 'temperature', 'humidity'])
+    hyperparameters = modellingConfig.get('multiOutputHyperparameters', {})
+    for name in names:
+        assert(name in MULTI_OUTPUT_LAYERS), 'Unknown layer of the multiOutput mode: ' + name
+    return [[name] + list(hyperparameters.get(name, [MULTI_OUTPUT_LAYERS[name]['sigmaF'], MULTI_OUTPUT_LAYERS[name]['sigmaN']])) for name in names]
+
+
+# part of the output of getTrainingData in [windowStart, windowEnd): the bins (compared by their epoch times) that lie in the window,
+# and the sensors with a measurement in them. With the bounds of the window on bin boundaries this is the output of getTrainingData
+# for the window, a bin that is only partly in the window is left out since its mean also holds measurements from outside of it.
+def trainingDataWindow(data_tr, windowStart, windowEnd, binFrequency):
+    if len(data_tr[3]) == 0:
+        return data_tr
+    startEpoch = calendar.timegm(windowStart.utctimetuple())
+    endEpoch = calendar.timegm(windowEnd.utctimetuple())
+    keep = np.flatnonzero((data_tr[3] >= startEpoch) & (data_tr[3] + binFrequency <= endEpoch))
+    return observedSensors([data_tr[0][keep], data_tr[1], data_tr[2], data_tr[3][keep], data_tr[4], data_tr[5],
+                            dict((name, values[keep]) for name, values in data_tr[6].items())])
+
+
+# output of getTrainingData without the sensors that have no PM2.5 measurement in any of its bins
+def observedSensors(data_tr):
+    observed = np.flatnonzero(~np.all(np.isnan(data_tr[0]), axis=0))
+    return [data_tr[0][:, observed], [data_tr[1][j] for j in observed], [data_tr[2][j] for j in observed], data_tr[3],
+            [data_tr[4][j] for j in observed], [data_tr[5][j] for j in observed], dict((name, values[:, observed]) for name, values in data_tr[6].items())]
+
+
+# estimation phase of the combined high and low uncertainty run in the exact mode: data_tr covers the low uncertainty window and the
+# high uncertainty window starts at the datetime subsetStart, so its measurements are a subset of the others and both estimates come
+# from one factorization (AQNestedGPR). Returns [estimate of subsetMesh, estimate of mesh], each like the output of estimateFromData.
+def estimateNestedFromData(data_tr, subsetStart, characteristicLength_space, characteristicLength_time, subsetMesh, mesh, blockSize=None):
+
+    nLats = len(data_tr[2])
+    relTimes = np.array(epoch2Reltime(data_tr[3], np.min(data_tr[3])))
+    inSubsetBin = data_tr[3] >= calendar.timegm(subsetStart.utctimetuple())
+
+    pm2p5_tr = findMissings(data_tr[0])
+    pm2p5_tr = np.matrix(pm2p5_tr, dtype=float)
+    pm2p5_tr = calibrate(pm2p5_tr, data_tr[4])
+    pm2p5_tr = pm2p5_tr.flatten().T
+
+    lat_tr = np.tile(np.matrix(data_tr[2]).T, [len(relTimes), 1])
+    long_tr = np.tile(np.matrix(data_tr[1]).T, [len(relTimes), 1])
+    time_tr = np.repeat(np.matrix(relTimes).T, nLats, axis=0)
+    x_tr = np.concatenate((lat_tr, long_tr, time_tr), axis=1)
+    measured = ~np.isnan(np.asarray(pm2p5_tr).ravel())
+    inSubset = np.repeat(inSubsetBin, nLats)[measured]
+    x_tr = x_tr[measured, :]
+    pm2p5_tr = pm2p5_tr[measured, :]
+
+    # the query times of a mesh are relative to the start of its window, the training times to the first bin of the whole window
+    x_QSubset = np.concatenate((np.matrix(subsetMesh['lats']), np.matrix(subsetMesh['lngs']), np.matrix(subsetMesh['times']) + relTimes[inSubsetBin].min()), axis=1)
+    x_Q = np.concatenate((np.matrix(mesh['lats']), np.matrix(mesh['lngs']), np.matrix(mesh['times'])), axis=1)
+
+    [[yPredSubset, yVarSubset], [yPred, yVar]] = AQNestedGPR(x_QSubset, x_Q, x_tr, pm2p5_tr, inSubset, sigmaF0=10, L0=[characteristicLength_space, characteristicLength_time/3600.0], sigmaN=4.2, basisFnDeg=1, blockSize=blockSize)
+
+    return [[yPredSubset, yVarSubset, x_QSubset[:, 0], x_QSubset[:, 1]], [yPred, yVar, x_Q[:, 0], x_Q[:, 1]]]
+
+
+# mesh of the points of a stored grid at every one of the relative query times
+def batchMesh(mesh, queryTimesRelative):
+    nPoints = len(mesh['lats'])
+    return {'lats': list(mesh['lats']) * len(queryTimesRelative), 'lngs': list(mesh['lngs']) * len(queryTimesRelative),
+            'times': [[aRelativeTime] for aRelativeTime in queryTimesRelative for i in range(nPoints)]}
+
+
+# splits the estimate of a batch mesh into the estimates of its nSlices time slices
+def splitEstimate(anEstimate, nSlices):
+    nPoints = anEstimate[0].shape[0] // nSlices
+    return [[part[k * nPoints:(k + 1) * nPoints] for part in anEstimate] for k in range(nSlices)]
+
+
 def calculateContours(X, Y, Z, endDate, levels, colorBands):
 
     # from: http://hplgit.github.io/web4sciapps/doc/pub/._part0013_web4sa_plain.html
@@ -231,7 +426,10 @@ def calculateContours(X, Y, Z, endDate, levels, colorBands):
     return new_contours
 
 
-def storeInMongo(configForModelling, client, theCollection, anEstimate, queryTime, endTime, levels, colorBands, theNowMinusCHLT, numberGridCells_LAT, numberGridCells_LONG):
+# the contours are calculated from the estimate unless they are given (cached), they are returned so that they can be cached
+# layers are the names of the other layers of the estimate (the extraOutputs of estimateFromData), every grid element stores their estimate
+# and variability next to the PM2.5 ones and the slice stores their contours in layerContours {name: contours}; returns [contours, layerContours]
+def storeInMongo(configForModelling, client, theCollection, anEstimate, queryTime, endTime, levels, colorBands, theNowMinusCHLT, numberGridCells_LAT, numberGridCells_LONG, contours=None, layers=[], layerContours=None):
 
     db = client.airudb
 
@@ -262,13 +460,27 @@ def storeInMongo(configForModelling, client, theCollection, anEstimate, queryTim
                     # LOGGER.info('found a match')
 
                     theEstimates[str(i)] = {'gridELementID': key, 'pm25': theEstimate['pm25'], 'variability': theEstimate['variability']}
+                    for j, name in enumerate(layers):
+                        theEstimates[str(i)][name] = float(anEstimate[4][i, j])
+                        theEstimates[str(i)][name + 'Variability'] = float(anEstimate[5][i, j])
                     break
         else:
             LOGGER.info('Did not find the appropriate estimation metadata.')
 
     # take the estimates and get the contours
     # binaryFile = calculateContours(latQuery, longQuery, pmEstimates)
-    contours = calculateContours(latQuery, longQuery, pmEstimates, queryTime, levels, colorBands)
+    if contours is None:
+        contours = calculateContours(latQuery, longQuery, pmEstimates, queryTime, levels, colorBands)
+
+    # a layer without any measurement in the window has no estimate (NaN), and no contours
+    if layerContours is None:
+        layerContours = {}
+        for j, name in enumerate(layers):
+            layerEstimates = np.asarray(anEstimate[4][:, j]).reshape(numberGridCells_LONG + 1, numberGridCells_LAT + 1)
+            if np.all(np.isnan(layerEstimates)):
+                layerContours[name] = []
+            else:
+                layerContours[name] = calculateContours(latQuery, longQuery, layerEstimates, queryTime, MULTI_OUTPUT_LAYERS[name]['levels'], MULTI_OUTPUT_LAYERS[name]['colorBands'])
 
     # save the contour svg serialized in the db.
 
@@ -279,6 +491,8 @@ def storeInMongo(configForModelling, client, theCollection, anEstimate, queryTim
                        "estimate": theEstimates,
                        # "location": location,
                        "contours": contours}
+    if layers:
+        anEstimateSlice['layerContours'] = layerContours
 
     if theNowMinusCHLT:
         # high variability estimation
@@ -320,6 +534,8 @@ def storeInMongo(configForModelling, client, theCollection, anEstimate, queryTim
 
         LOGGER.info('inserted data slice for %s into %s', queryTime.strftime('%Y-%m-%dT%H:%M:%SZ'), theCollection)
 
+    return [contours, layerContours]
+
 
 def storeGridMetadata(client, gridID, metadataType, numberGridCells_LAT, numberGridCells_LONG, theMesh, theBottomLeftCorner, theTopRightCorner):
 
@@ -344,21 +560,36 @@ def storeGridMetadata(client, gridID, metadataType, numberGridCells_LAT, numberG
     LOGGER.info('inserted estimation Metadata %s', gridID)
 
 
-def main(args):
+# preloaded: {'start': startDate, 'end': endDate, 'data': output of getTrainingData from startDate to endDate} covering the windows of the
+# run (e.g. the whole range of a backfill), the run takes its bins from it (trainingDataWindow) instead of querying InfluxDB
+def main(args, preloaded=None):
 
     start01 = time.time()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("highUncertainty", help="true means only now() to now()-characteristicLength, false means now() to now()-characteristicLength and to now()-2*characteristicLength")
+    parser.add_argument("highUncertainty", help="true means only now() to now()-characteristicLength, false means now() to now()-characteristicLength and to now()-2*characteristicLength, both does the two estimations with one data query")
     # parser.add_argument("--debugging", help="true means debugging")
     parser.add_argument("-d", "--debugging", help="name of config file")
     parser.add_argument("-q", "--querytime", help="query time (UTC) for estimation with format: %Y-%m-%dT%H:%M:%SZ")
+    parser.add_argument("-b", "--batchend", help="query time (UTC) of the last slice of a batch with format: %Y-%m-%dT%H:%M:%SZ, all the slices from the query time on share one factorization (low uncertainty only)")
+    parser.add_argument("-i", "--batchinterval", help="seconds between the slices of a batch, binFrequency by default")
+    parser.add_argument("-s", "--statesuffix", help="suffix of the state files of the rolling mode, runs that can be concurrent (e.g. the workers of a backfill) need their own state")
+    parser.add_argument("-n", "--nocache", action="store_true", help="neither reuse nor store estimates in the estimation cache (e.g. the batches of a backfill, which never repeat)")
 
     args = parser.parse_args(args)
 
     # true means only now()-characteristicLength;
     # false means now() to now()-characteristicLength and to now()-2*characteristicLength
-    nowMinusCHLT = bool(strtobool(args.highUncertainty))
+    # both estimates the high and the low uncertainty slices from the measurements of the low uncertainty window
+    if args.highUncertainty.lower() == 'both':
+        uncertainties = [True, False]
+    else:
+        uncertainties = [bool(strtobool(args.highUncertainty))]
+
+    # the slices of a batch are trained on the measurements up to the end of the batch, the high uncertainty estimates may only see the
+    # measurements up to their own query time
+    if args.batchend and True in uncertainties:
+        parser.error('a batch (--batchend) can only estimate the low uncertainty collection, highUncertainty has to be false')
 
     theQueryTime = currentUTCtime
 
@@ -393,22 +624,63 @@ def main(args):
     characteristicSpaceLength = modellingConfig['characteristicSpaceLength']
     binFrequency = modellingConfig['binFrequency']
     theGridID = modellingConfig['currentGridVersion']
+    # number of query points predicted at once, limits the memory used by the estimation (None predicts the whole mesh at once)
+    predictionBlockSize = modellingConfig.get('predictionBlockSize')
+    # 'exact' factorizes all the measurements, 'kronecker' uses the sensor x time grid structure and 'stateSpace' runs a Kalman smoother over
+    # the time bins (same estimates, much faster for long windows), 'sparse' is an inducing point approximation for very large networks
+    # 'tiled' solves spatial tiles of the mesh with their neighboring sensors only, 'tapered' uses a compactly supported (sparse) covariance
+    # and 'rolling' updates the factorization of the previous run of the same collection; 'multiOutput' is the exact estimate of the PM2.5
+    # that also estimates the layers of multiOutputLayers (e.g. PM10, temperature) with the factorizations shared between them
+    estimationMode = modellingConfig.get('estimationMode', 'exact')
+    extraOutputs = multiOutputLayers(modellingConfig)
+    layers = [anOutput[0] for anOutput in extraOutputs]
+    # inducing points of the sparse mode: [lat, long, time] size of the lattice over the bounding box, and the approximation ('FITC' or 'VFE')
+    inducingGrid = modellingConfig.get('sparseInducingGrid', [10, 10, 4])
+    sparseMethod = modellingConfig.get('sparseMethod', 'FITC')
+    # tiles of the tiled mode: their size in km (None is 4 space lengths), the neighborhood radius in space lengths and the number of processes
+    tileSize = modellingConfig.get('tileSize')
+    tileRadiusFactor = modellingConfig.get('tileRadiusFactor', 3.0)
+    tileProcesses = modellingConfig.get('tileProcesses', 1)
+    # distance in km beyond which the covariance of the tapered mode is zero (None is 5 space lengths)
+    taperRange = modellingConfig.get('taperRange')
+    # directory of the state files of the rolling mode, one file per collection (and state suffix)
+    rollingStateDirectory = modellingConfig.get('rollingStateDirectory', sys.path[0])
+    rollingStateSuffix = '_' + args.statesuffix if args.statesuffix else ''
+    # cache of the estimates of the previous runs, keyed by the fingerprint of their inputs, with at most estimationCacheSize entries
+    useEstimationCache = modellingConfig.get('useEstimationCache', True) and not args.nocache
+    estimationCacheDirectory = modellingConfig.get('estimationCacheDirectory', os.path.join(sys.path[0], 'estimationCache'))
+    estimationCacheSize = modellingConfig.get('estimationCacheSize', 20)
+    # directory of the cached spatial cross covariances between the mesh and the sensors of the exact mode (None does not cache them)
+    crossCovarianceCacheDirectory = modellingConfig.get('crossCovarianceCacheDirectory')
+    # threads of the InfluxDB queries, and the most queries sent to one database at once
+    queryThreads = modellingConfig.get('queryThreads', 8)
+    queriesPerSource = modellingConfig.get('queriesPerSource', 4)
+
+    # the end of the window of every time slice, a batch estimates all its slices from the union of their windows with one factorization
+    endDates = [theQueryTime]
+    if args.batchend:
+        batchEnd = datetime.strptime(args.batchend, '%Y-%m-%dT%H:%M:%SZ')
+        batchInterval = timedelta(seconds=int(args.batchinterval) if args.batchinterval else binFrequency)
+        while endDates[-1] + batchInterval <= batchEnd:
+            endDates.append(endDates[-1] + batchInterval)
+    endDate = endDates[-1]
+
+    # depending on high or low uncertainty argument generate start time, end time and query times of every collection
+    runs = []
+    for nowMinusCHLT in uncertainties:
+        if nowMinusCHLT:
+            startDate = theQueryTime - timedelta(seconds=characteristicTimeLength)
+            queryTimes = list(endDates)
+            collection = modellingConfig['metadataType_highUncertainty']
+        else:
+            startDate = theQueryTime - timedelta(seconds=(2 * characteristicTimeLength))
+            queryTimes = [anEndDate - timedelta(seconds=characteristicTimeLength) for anEndDate in endDates]
+            collection = modellingConfig['metadataType_lowUncertainty']
 
-    # depending on high or low uncertainty argument generate start time, end time and query time
-    if nowMinusCHLT:
-        startDate = theQueryTime - timedelta(seconds=characteristicTimeLength)
-        endDate = theQueryTime
-        queryTime = endDate
-        collection = modellingConfig['metadataType_highUncertainty']
-    else:
-        startDate = theQueryTime - timedelta(seconds=(2 * characteristicTimeLength))
-        endDate = theQueryTime
-        queryTime = endDate - timedelta(seconds=characteristicTimeLength)
-        collection = modellingConfig['metadataType_lowUncertainty']
-
-    # the relative time is always with respect to the start time
-    queryTimeRelative = datetime2Reltime([queryTime], startDate)
-    # print(queryTimeRelative)
+        # the relative time is always with respect to the start time
+        runs.append({'nowMinusCHLT': nowMinusCHLT, 'startDate': startDate, 'queryTimes': queryTimes, 'collection': collection,
+                     'queryTimesRelative': datetime2Reltime(queryTimes, startDate),
+                     'rollingStatePath': os.path.join(rollingStateDirectory, 'rollingModel_' + collection + rollingStateSuffix + '.npz')})
 
     config = getConfig('../config/', 'config.json')
 
@@ -428,31 +700,35 @@ def main(args):
     mongoClient = MongoClient(mongodb_url)
     db = mongoClient.airudb
 
-    # query estimationMetadata table if already modeling parameters for the combination of metadataType and gridID exist
-    # metadataType provides information about high or low uncertainty, bascially gives a description keyword
-    # gridID describes the iteration number
-    meshgridInfo = db.estimationMetadata.find_one({"metadataType": collection, "gridID": theGridID})
+    for aRun in runs:
+        # query estimationMetadata table if already modeling parameters for the combination of metadataType and gridID exist
+        # metadataType provides information about high or low uncertainty, bascially gives a description keyword
+        # gridID describes the iteration number
+        meshgridInfo = db.estimationMetadata.find_one({"metadataType": aRun['collection'], "gridID": theGridID})
 
-    # print(meshgridInfo)
+        # print(meshgridInfo)
 
-    if meshgridInfo is None:
+        if meshgridInfo is None:
 
-        # geographical area
-        bottomLeftCorner = {'lat': modellingConfig['bottomLeftCorner_LAT'], 'lng': modellingConfig['bottomLeftCorner_LONG']}
-        topRightCorner = {'lat': modellingConfig['topRightCorner_LAT'], 'lng': modellingConfig['topRightCorner_LONG']}
+            # geographical area
+            aRun['bottomLeftCorner'] = {'lat': modellingConfig['bottomLeftCorner_LAT'], 'lng': modellingConfig['bottomLeftCorner_LONG']}
+            aRun['topRightCorner'] = {'lat': modellingConfig['topRightCorner_LAT'], 'lng': modellingConfig['topRightCorner_LONG']}
 
-        numberGridCells_LAT = modellingConfig['numberGridCells_LAT']
-        numberGridCells_LONG = modellingConfig['numberGridCells_LONG']
+            aRun['numberGridCells_LAT'] = modellingConfig['numberGridCells_LAT']
+            aRun['numberGridCells_LONG'] = modellingConfig['numberGridCells_LONG']
 
-        mesh = generateQueryMeshVariableGrid(numberGridCells_LAT, numberGridCells_LONG, bottomLeftCorner, topRightCorner, queryTimeRelative)
+            aRun['mesh'] = generateQueryMeshVariableGrid(aRun['numberGridCells_LAT'], aRun['numberGridCells_LONG'], aRun['bottomLeftCorner'], aRun['topRightCorner'], aRun['queryTimesRelative'][:1])
 
-        storeGridMetadata(mongoClient, theGridID, collection, int(numberGridCells_LAT), int(numberGridCells_LONG), mesh, bottomLeftCorner, topRightCorner)
-    else:
-        mesh = meshgridInfo['grid']
-        numberGridCells_LAT = meshgridInfo['numberOfGridCells']['lat']
-        numberGridCells_LONG = meshgridInfo['numberOfGridCells']['long']
-        bottomLeftCorner = meshgridInfo['bottomLeftCorner']
-        topRightCorner = meshgridInfo['topRightCorner']
+            storeGridMetadata(mongoClient, theGridID, aRun['collection'], int(aRun['numberGridCells_LAT']), int(aRun['numberGridCells_LONG']), aRun['mesh'], aRun['bottomLeftCorner'], aRun['topRightCorner'])
+        else:
+            aRun['mesh'] = meshgridInfo['grid']
+            aRun['numberGridCells_LAT'] = meshgridInfo['numberOfGridCells']['lat']
+            aRun['numberGridCells_LONG'] = meshgridInfo['numberOfGridCells']['long']
+            aRun['bottomLeftCorner'] = meshgridInfo['bottomLeftCorner']
+            aRun['topRightCorner'] = meshgridInfo['topRightCorner']
+
+        # the grid of the collection at every query time of the batch
+        aRun['batchMesh'] = batchMesh(aRun['mesh'], aRun['queryTimesRelative'])
 
     end02 = time.time()
     diff02 = end02 - start02
@@ -463,35 +739,57 @@ def main(args):
     # colorBands = ('#a6d96a', '#ffffbf', '#fdae61', '#d7191c', '#bd0026', '#a63603')
     colorBands = ('#31a354', '#a1d99b', '#e5f5e0', '#ffffcc', '#ffeda0', '#fed976', '#feb24c', '#fd8d3c', '#fc4e2a', '#e31a1c', '#bd0026', '#800026')
 
-    # PurpleAir client
-    pAirClient = InfluxDBClient(
-        config['INFLUX_HOST'],
-        config['INFLUX_PORT'],
-        config['INFLUX_MODELLING_USERNAME'],
-        config['INFLUX_MODELLING_PASSWORD'],
-        config['PURPLE_AIR_DB'],
-        ssl=True,
-        verify_ssl=True
-    )
-
-    # airU client
-    airUClient = InfluxDBClient(
-        config['INFLUX_HOST'],
-        config['INFLUX_PORT'],
-        config['INFLUX_MODELLING_USERNAME'],
-        config['INFLUX_MODELLING_PASSWORD'],
-        config['AIRU_DB'],
-        ssl=True,
-        verify_ssl=True
-    )
-
-    dbs = {'airu_pm25_measurement': config['INFLUX_AIRU_PM25_MEASUREMENT'],
-           'airu_lat_measurement': config['INFLUX_AIRU_LATITUDE_MEASUREMENT'],
-           'airu_long_measurement': config['INFLUX_AIRU_LONGITUDE_MEASUREMENT']}
-
     start03 = time.time()
 
-    theEstimate = getEstimate(pAirClient, airUClient, dbs, characteristicSpaceLength, characteristicTimeLength, mesh, startDate, endDate, bottomLeftCorner, topRightCorner, binFrequency)
+    # one query covers the windows and the areas of all the runs, each run takes the end of it that starts with its own window
+    windowStart = min(aRun['startDate'] for aRun in runs)
+    bottomLeftCorner = {'lat': min(aRun['bottomLeftCorner']['lat'] for aRun in runs), 'lng': min(aRun['bottomLeftCorner']['lng'] for aRun in runs)}
+    topRightCorner = {'lat': max(aRun['topRightCorner']['lat'] for aRun in runs), 'lng': max(aRun['topRightCorner']['lng'] for aRun in runs)}
+    if preloaded is None:
+        [newPAirClient, newAirUClient, dbs] = getInfluxClientFactories(config)
+        data_tr = observedSensors(getTrainingData(newPAirClient, newAirUClient, dbs, windowStart, endDate, bottomLeftCorner, topRightCorner, binFrequency, queryThreads, queriesPerSource, layers))
+    else:
+        assert(preloaded['start'] <= windowStart and endDate <= preloaded['end']), 'The window of the run is not in the range of the preloaded measurements!'
+        assert(all(name in preloaded['data'][6] for name in layers)), 'The preloaded measurements do not have all the layers of the run!'
+        data_tr = trainingDataWindow(preloaded['data'], windowStart, endDate, binFrequency)
+
+    # a run with the same measurements (relative to the first bin), sensors, hyperparameters, mesh and estimation settings as a cached one
+    # reuses its estimate and contours, only the time of the stored slice changes
+    modeOptions = {'inducingGrid': inducingGrid, 'sparseMethod': sparseMethod, 'tileSize': tileSize, 'tileRadiusFactor': tileRadiusFactor, 'tileProcesses': tileProcesses, 'taperRange': taperRange,
+                   'crossCovarianceCache': crossCovarianceCacheDirectory is not None, 'extraOutputs': extraOutputs}
+    for aRun in runs:
+        if aRun['startDate'] == windowStart:
+            aRun['data'] = data_tr
+        else:
+            aRun['data'] = trainingDataWindow(data_tr, aRun['startDate'], endDate, binFrequency)
+        runData = aRun['data']
+        aRun['fingerprint'] = estimationFingerprint(np.array(runData[0], dtype=float), np.array(runData[1], dtype=float), np.array(runData[2], dtype=float), epoch2Reltime(runData[3], np.min(runData[3])) if len(runData[3]) else [],
+                                                    list(runData[4]), dict((name, np.array(runData[6][name], dtype=float)) for name in layers), aRun['queryTimesRelative'], characteristicSpaceLength, characteristicTimeLength, theGridID, aRun['collection'], estimationMode, modeOptions)
+        aRun['cached'] = None
+        if useEstimationCache:
+            aRun['cached'] = loadCachedEstimate(estimationCacheDirectory, aRun['fingerprint'])
+
+        if aRun['cached'] is not None:
+            aRun['estimates'] = aRun['cached']['estimates']
+            aRun['contours'] = aRun['cached']['contours']
+            aRun['layerContours'] = aRun['cached'].get('layerContours', [None] * len(endDates))
+            LOGGER.info('reusing the cached estimate %s of %s', aRun['fingerprint'], aRun['collection'])
+        else:
+            aRun['estimates'] = None
+            aRun['contours'] = [None] * len(endDates)
+            aRun['layerContours'] = [None] * len(endDates)
+
+    toEstimate = [aRun for aRun in runs if aRun['estimates'] is None]
+    if len(toEstimate) == 2 and estimationMode == 'exact' and crossCovarianceCacheDirectory is None:
+        # the measurements of the high uncertainty run are the end of the low uncertainty ones, both estimates share one factorization
+        [highRun, lowRun] = toEstimate
+        [highEstimate, lowEstimate] = estimateNestedFromData(data_tr, highRun['startDate'], characteristicSpaceLength, characteristicTimeLength, highRun['batchMesh'], lowRun['batchMesh'], predictionBlockSize)
+        highRun['estimates'] = splitEstimate(highEstimate, len(endDates))
+        lowRun['estimates'] = splitEstimate(lowEstimate, len(endDates))
+    else:
+        for aRun in toEstimate:
+            anEstimate = estimateFromData(aRun['data'], characteristicSpaceLength, characteristicTimeLength, aRun['batchMesh'], aRun['bottomLeftCorner'], aRun['topRightCorner'], predictionBlockSize, estimationMode, inducingGrid, sparseMethod, tileSize, tileRadiusFactor, tileProcesses, taperRange, aRun['rollingStatePath'], theGridID, crossCovarianceCacheDirectory, extraOutputs)
+            aRun['estimates'] = splitEstimate(anEstimate, len(endDates))
 
     end03 = time.time()
     diff03 = end03 - start03
@@ -499,13 +797,20 @@ def main(args):
 
     start04 = time.time()
 
-    storeInMongo(modellingConfig, mongoClient, collection, theEstimate, queryTime, endDate, levels, colorBands, nowMinusCHLT, numberGridCells_LAT, numberGridCells_LONG)
+    for aRun in runs:
+        for k in range(len(endDates)):
+            [aRun['contours'][k], aRun['layerContours'][k]] = storeInMongo(modellingConfig, mongoClient, aRun['collection'], aRun['estimates'][k], aRun['queryTimes'][k], endDates[k], levels, colorBands, aRun['nowMinusCHLT'], aRun['numberGridCells_LAT'], aRun['numberGridCells_LONG'], aRun['contours'][k], layers, aRun['layerContours'][k])
+
+        if useEstimationCache and aRun['cached'] is None:
+            storeCachedEstimate(estimationCacheDirectory, aRun['fingerprint'], {'estimates': aRun['estimates'], 'contours': aRun['contours'], 'layerContours': aRun['layerContours']}, estimationCacheSize)
 
     end04 = time.time()
     diff04 = end04 - start04
     LOGGER.info('generating contour and storing data phase took %s', diff04)
 
-    LOGGER.info('successful estimation of %s for %s', collection, queryTime.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    for aRun in runs:
+        for queryTime in aRun['queryTimes']:
+            LOGGER.info('successful estimation of %s for %s', aRun['collection'], queryTime.strftime('%Y-%m-%dT%H:%M:%SZ'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+from utility_tools import kernelMatrix, longLat2Km
+
+
+# Persistent cache of the spatial factor of the cross covariance between the query mesh of a grid version and the sensors.
+# The mesh of a grid version never changes and most sensors do not move, so the columns exp(-r/Ls) of every sensor are kept
+# in one file per grid version and spatial length scale, together with the km coordinates of the mesh and of the sensors.
+# A sensor column is recalculated when the sensor is new or has moved; the time factor is multiplied in at run time.
+# All the coordinates use the fixed projection of the mesh (meshProjection), so that they do not depend on the sensors of a run.
+
+
+# Fixed projection of a grid version: [longOrigin, latOrigin, meanLat] of its mesh
+def meshProjection(meshLats, meshLongs):
+    return np.array([np.min(meshLongs), np.min(meshLats), np.mean(meshLats)])
+
+
+def projectLatLong(lats, longs, projection):
+    [xh, xv] = longLat2Km(np.asarray(longs, dtype=float).ravel(), np.asarray(lats, dtype=float).ravel(), projection[0], projection[1], projection[2])
+    return np.column_stack((np.asarray(xh).ravel(), np.asarray(xv).ravel()))
+
+
+# Returns [Ks, meshKm, sensorKm]: the nMesh x nSensors spatial kernel with unit variance (the length scales are [Ls, Ls]),
+# and the projected coordinates of the mesh and of the sensors. The cache file of the grid version and Ls is updated when needed.
+def spatialCrossCovariance(cacheDir, gridID, meshLats, meshLongs, Ls, sensorIDs, sensorLats, sensorLongs, kerType='Exp'):
+    meshLats = np.asarray(meshLats, dtype=float).ravel()
+    meshLongs = np.asarray(meshLongs, dtype=float).ravel()
+    sensorIDs = [str(anID) for anID in sensorIDs]
+    sensorLats = np.asarray(sensorLats, dtype=float).ravel()
+    sensorLongs = np.asarray(sensorLongs, dtype=float).ravel()
+    cachePath = os.path.join(cacheDir, 'crossCovariance_' + str(gridID) + '_' + repr(float(Ls)) + '.npz')
+
+    cache = loadCrossCovariance(cachePath, meshLats, meshLongs)
+    if cache is None:
+        projection = meshProjection(meshLats, meshLongs)
+        cache = {'meshLats': meshLats, 'meshLongs': meshLongs, 'projection': projection, 'meshKm': projectLatLong(meshLats, meshLongs, projection),
+                 'ids': np.array([], dtype=str), 'lats': np.zeros(0), 'longs': np.zeros(0), 'columns': np.zeros((len(meshLats), 0))}
+
+    column = dict((anID, i) for i, anID in enumerate(cache['ids'].tolist()))
+    # new sensors and sensors that moved since they were cached
+    stale = [i for i, anID in enumerate(sensorIDs) if anID not in column or cache['lats'][column[anID]] != sensorLats[i] or cache['longs'][column[anID]] != sensorLongs[i]]
+    if stale:
+        staleKm = projectLatLong(sensorLats[stale], sensorLongs[stale], cache['projection'])
+        newColumns = kernelMatrix(cache['meshKm'], staleKm, 1.0, [Ls, Ls], kerType)
+        staleIDs = set(sensorIDs[j] for j in stale)
+        keep = [i for i, anID in enumerate(cache['ids'].tolist()) if anID not in staleIDs]
+        cache['ids'] = np.concatenate((cache['ids'][keep], np.array([sensorIDs[j] for j in stale])))
+        cache['lats'] = np.concatenate((cache['lats'][keep], sensorLats[stale]))
+        cache['longs'] = np.concatenate((cache['longs'][keep], sensorLongs[stale]))
+        cache['columns'] = np.concatenate((cache['columns'][:, keep], newColumns), axis=1)
+        saveCrossCovariance(cachePath, cache)
+        column = dict((anID, i) for i, anID in enumerate(cache['ids'].tolist()))
+
+    idx = [column[anID] for anID in sensorIDs]
+    return [cache['columns'][:, idx], cache['meshKm'], projectLatLong(sensorLats, sensorLongs, cache['projection'])]
+
+
+# The cache of a file is only valid for the mesh it was calculated for
+def loadCrossCovariance(cachePath, meshLats, meshLongs):
+    if not os.path.isfile(cachePath):
+        return None
+    data = np.load(cachePath)
+    cache = dict((key, data[key]) for key in data.files)
+    data.close()
+    if not (np.array_equal(cache['meshLats'], meshLats) and np.array_equal(cache['meshLongs'], meshLongs)):
+        return None
+    return cache
+
+
+def saveCrossCovariance(cachePath, cache):
+    if not os.path.isdir(os.path.dirname(cachePath)):
+        os.makedirs(os.path.dirname(cachePath))
+    with open(cachePath + '.tmp', 'wb') as cacheFile:
+        np.savez(cacheFile, **cache)
+    os.rename(cachePath + '.tmp', cachePath)
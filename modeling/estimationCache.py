@@ -0,0 +1,119 @@
+import cPickle as pickle
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# Content addressed cache of the estimates. An entry is keyed by the fingerprint of the inputs of the model (measurements, sensors,
+# hyperparameters, mesh, ...) and holds its outputs (posterior and contours); the entries are pickle files in cacheDir, and the least
+# recently used ones are evicted when there are more than maxEntries. The index is only read and written under an exclusive lock,
+# so that concurrent runs sharing cacheDir do not lose each other's updates and evictions.
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+
+
+# SHA-1 fingerprint of any combination of numpy arrays, lists, dicts, numbers and strings
+def estimationFingerprint(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        updateFingerprint(sha, part)
+    return sha.hexdigest()
+
+
+def updateFingerprint(sha, part):
+    if isinstance(part, np.ndarray):
+        part = np.ascontiguousarray(part)
+        sha.update(str(part.dtype) + str(part.shape))
+        sha.update(part.tobytes())
+    elif isinstance(part, (list, tuple)):
+        sha.update('[' + str(len(part)))
+        for item in part:
+            updateFingerprint(sha, item)
+    elif isinstance(part, dict):
+        sha.update('{' + str(len(part)))
+        for key in sorted(part):
+            updateFingerprint(sha, key)
+            updateFingerprint(sha, part[key])
+    else:
+        sha.update(type(part).__name__ + repr(part))
+
+
+# Returns the cached entry of the fingerprint (and marks it as used), None if there is none
+def loadCachedEstimate(cacheDir, fingerprint):
+    if not os.path.isdir(cacheDir):
+        return None
+    with indexLock(cacheDir):
+        index = readIndex(cacheDir)
+        entryPath = os.path.join(cacheDir, fingerprint + '.pkl')
+        if fingerprint not in index or not os.path.isfile(entryPath):
+            return None
+        with open(entryPath, 'rb') as entryFile:
+            entry = pickle.load(entryFile)
+        index[fingerprint] = time.time()
+        writeIndex(cacheDir, index)
+    return entry
+
+
+# Stores the entry of the fingerprint and evicts the least recently used entries beyond maxEntries, and the entry files that are not
+# in the index (left by a run that stopped between writing its entry and the index)
+def storeCachedEstimate(cacheDir, fingerprint, entry, maxEntries=20):
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            # created by a concurrent run
+            if not os.path.isdir(cacheDir):
+                raise
+    entryPath = os.path.join(cacheDir, fingerprint + '.pkl')
+    tmpPath = entryPath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpPath, 'wb') as entryFile:
+        pickle.dump(entry, entryFile, pickle.HIGHEST_PROTOCOL)
+
+    with indexLock(cacheDir):
+        os.rename(tmpPath, entryPath)
+        index = readIndex(cacheDir)
+        index[fingerprint] = time.time()
+        for oldFingerprint in sorted(index, key=index.get)[:max(len(index) - maxEntries, 0)]:
+            del index[oldFingerprint]
+        for fileName in os.listdir(cacheDir):
+            if fileName.endswith('.pkl') and fileName[:-len('.pkl')] not in index:
+                os.remove(os.path.join(cacheDir, fileName))
+        writeIndex(cacheDir, index)
+
+
+# Exclusive lock of the index of cacheDir, held while it is read, updated and written
+@contextmanager
+def indexLock(cacheDir):
+    with open(os.path.join(cacheDir, LOCK_FILE), 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+# The index maps every fingerprint of the cache to the time it was last used
+def readIndex(cacheDir):
+    indexPath = os.path.join(cacheDir, INDEX_FILE)
+    if not os.path.isfile(indexPath):
+        return {}
+    try:
+        with open(indexPath, 'r') as indexFile:
+            return json.loads(indexFile.read())
+    except ValueError:
+        # a corrupted index only costs the cached entries
+        return {}
+
+
+def writeIndex(cacheDir, index):
+    indexPath = os.path.join(cacheDir, INDEX_FILE)
+    with open(indexPath + '.tmp', 'w') as indexFile:
+        indexFile.write(json.dumps(index))
+    os.rename(indexPath + '.tmp', indexPath)
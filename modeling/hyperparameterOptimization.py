@@ -0,0 +1,77 @@
+import numpy as np
+from scipy.optimize import minimize
+from gradDescent import gradDescent
+
+# bounds used for the hyperparameters (length scales, sigmaF and sigmaN) if none are given
+DEFAULT_BOUNDS = (1e-4, 1e4)
+
+
+def optimizeHyperparameters(Fun, theta0, optList, method='L-BFGS-B', tol=1e-5, maxIt=400, learnRate=1e-3, bounds=None):
+# Finds the theta values that minimizes the objective function Fun with the chosen optimizer and reports how it converged
+#
+# Fun: a function that returns the objective and its gradient (as a column matrix) with respect to theta
+# theta0: initial values for theta
+# optList: a boolean list that defines which dimensions of theta to be optimized, the others keep their initial values
+# method: 'L-BFGS-B' or 'gradDescent' (fixed learning rate)
+# tol: the convergence tolerance
+# maxIt: the maximum number of iterations allowed
+# learnRate: the learning rate, only used by gradDescent
+# bounds: a list of (lower, upper) bounds for every dimension of theta, only used by L-BFGS-B
+
+    if method == 'L-BFGS-B':
+        return lbfgsOpt(Fun, theta0, optList, tol, maxIt, bounds)
+    elif method == 'gradDescent':
+        nFev = [0]
+        objs = []
+
+        def countedFun(theta):
+            nFev[0] += 1
+            obj, grad = Fun(theta)
+            objs.append(float(obj))
+            return obj, grad
+
+        theta = gradDescent(countedFun, theta0, optList, tol, learnRate, maxIt, True)
+        report = {'method': method,
+                  'converged': nFev[0] <= maxIt + 1,
+                  'nIt': nFev[0] - 1,
+                  'nFev': nFev[0],
+                  'objective': objs[-1],
+                  'message': 'fixed learning rate gradient descent'}
+        return theta, report
+    else:
+        raise ValueError('Unknown optimization method: ' + str(method))
+
+
+# L-BFGS-B over the logarithm of the optimized hyperparameters, which keeps them positive and makes the problem better scaled
+def lbfgsOpt(Fun, theta0, optList, tol, maxIt, bounds=None):
+    theta0 = [float(t) for t in theta0]
+    assert(len(optList) == len(theta0)), 'You need to specify for each dimension of theta whether it is optimized or not.'
+    freeIdx = [i for i, opt in enumerate(optList) if opt]
+    assert(all(theta0[i] > 0 for i in freeIdx)), 'The initial values of the optimized hyperparameters should be positive.'
+    if bounds is None:
+        bounds = [DEFAULT_BOUNDS] * len(theta0)
+
+    def toTheta(phi):
+        theta = list(theta0)
+        for k, i in enumerate(freeIdx):
+            theta[i] = float(np.exp(phi[k]))
+        return theta
+
+    def logFun(phi):
+        theta = toTheta(phi)
+        obj, grad = Fun(theta)
+        grad = np.asarray(grad, dtype=float).ravel()
+        # chain rule for theta = exp(phi)
+        return float(obj), np.array([grad[i] * theta[i] for i in freeIdx])
+
+    phi0 = np.log([theta0[i] for i in freeIdx])
+    logBounds = [(np.log(bounds[i][0]), np.log(bounds[i][1])) for i in freeIdx]
+    res = minimize(logFun, phi0, method='L-BFGS-B', jac=True, bounds=logBounds, options={'maxiter': maxIt, 'ftol': tol})
+
+    report = {'method': 'L-BFGS-B',
+              'converged': bool(res.success),
+              'nIt': int(res.nit),
+              'nFev': int(res.nfev),
+              'objective': float(res.fun),
+              'message': str(res.message)}
+    return toTheta(res.x), report
@@ -0,0 +1,172 @@
+import numpy as np
+from scipy.linalg import cho_solve, eigh
+from utility_tools import basisMatrix, jitterCholesky, kernelMatrix
+
+
+# Gaussian Process Regression on a sensor x time grid, for kernels that are a product of a spatial and a temporal factor.
+# The covariance of the full grid is sigmaF^2 * Kt (x) Ks + sigmaN^2 * I, the missing grid cells are handled with a masked
+# conjugate gradient (mean) and an exact low rank correction (variance), so the cost is about O(S^3 + T^3) instead of O((S*T)^3).
+# Sensors and time bins without any observation are left out of the grid. The low rank correction costs O(nMissing^3), so when more
+# than maxMissingFraction of the cells are missing the variance falls back to the Cholesky factor of the observed cells, O(nObserved^3).
+#
+# xs: S x 2 spatial coordinates of the sensors
+# t: the T time bins
+# Y: T x S observations, NaN for the missing grid cells; grid cell (i, j) is the training point i * S + j
+# xQuery: nQuery x 3 query points (spatial coordinates and time)
+# L: the spatial length scales followed by the temporal length scale, [Ls, Ls, Lt]
+def kroneckerGpRegression(xs, t, Y, xQuery, sigmaF, L, sigmaN, basisFnDeg, kerType='Exp', center=True, calcVar=True, blockSize=None, tol=1e-10, maxIt=1000, maxMissingFraction=0.3):
+    assert(len(L) == 3), 'The Kronecker mode needs two spatial length scales and one temporal length scale'
+    xs = np.asarray(xs, dtype=float)
+    t = np.asarray(t, dtype=float).ravel()
+    Y = np.array(Y, dtype=float)
+    xQuery = np.asarray(xQuery, dtype=float)
+    nT = len(t)
+    nS = xs.shape[0]
+    assert(Y.shape == (nT, nS)), 'The observations should be a (number of time bins) x (number of sensors) matrix'
+
+    mask = ~np.isnan(Y)
+    if mask.any():
+        # the posterior does not depend on the cells of a sensor or a bin that are all missing
+        observedBins = mask.any(axis=1)
+        observedSensors = mask.any(axis=0)
+        t = t[observedBins]
+        xs = xs[observedSensors, :]
+        Y = Y[observedBins][:, observedSensors]
+        mask = mask[observedBins][:, observedSensors]
+        [nT, nS] = Y.shape
+    Y[~mask] = 0.0
+    yMean = 0.0
+    if basisFnDeg < 0 and center:
+        yMean = np.mean(Y[mask])
+        Y[mask] -= yMean
+
+    Ks = kernelMatrix(xs, xs, 1.0, L[:2], kerType)
+    Kt = temporalKernel(t, t, L[2], kerType)
+    [lamS, Qs] = eigh(Ks)
+    [lamT, Qt] = eigh(Kt)
+    # eigenvalues of the full grid covariance, negative round-off of the factors' eigenvalues is clipped
+    lam = sigmaF**2 * np.outer(np.maximum(lamT, 0), np.maximum(lamS, 0))
+    invLam = 1.0 / (lam + sigmaN**2)
+
+    # solves of the complete grid covariance, for a stack of T x S arrays
+    def gridSolve(V):
+        return np.einsum('ij,rjk->rik', Qt, np.einsum('ij,rjk->rik', Qt.T, V).dot(Qs) * invLam).dot(Qs.T)
+
+    def maskedProduct(V):
+        return mask * (sigmaF**2 * np.einsum('ij,rjk->rik', Kt, V).dot(Ks)) + sigmaN**2 * V
+
+    isComplete = mask.all()
+    if isComplete:
+        solve = gridSolve
+    else:
+        solve = lambda B: maskedConjugateGradient(maskedProduct, lambda V: mask * gridSolve(V), B, tol, maxIt)
+
+    # the observations and the basis functions are solved together
+    if basisFnDeg >= 0:
+        tGrid = np.repeat(t, nS)
+        xGrid = np.concatenate((np.tile(xs, (nT, 1)), tGrid[:, np.newaxis]), axis=1)
+        H = np.asarray(basisMatrix(xGrid, basisFnDeg)).reshape(-1, nT, nS) * mask
+        solved = solve(np.concatenate((Y[np.newaxis], H), axis=0))
+        invKy = solved[0]
+        invKH = solved[1:]
+        nBasis = H.shape[0]
+        cholA = jitterCholesky(H.reshape(nBasis, -1).dot(invKH.reshape(nBasis, -1).T))
+        Beta = cho_solve((cholA, True), np.sum(H * invKy, axis=(1, 2)))
+        alpha = invKy - np.tensordot(Beta, invKH, axes=(0, 0))
+    else:
+        alpha = solve(Y[np.newaxis])[0]
+
+    missIdx = np.flatnonzero(~mask.ravel())
+    isLowRank = not isComplete and len(missIdx) <= maxMissingFraction * nT * nS
+    if calcVar and isLowRank:
+        # exact posterior with missing cells: the observed block of the inverse is K^-1 - K^-1 E (E.T K^-1 E)^-1 E.T K^-1,
+        # with K the complete grid covariance and E the columns of the identity at the missing cells
+        E = np.zeros((len(missIdx), nT * nS))
+        E[np.arange(len(missIdx)), missIdx] = 1.0
+        G = gridSolve(E.reshape(-1, nT, nS)).reshape(len(missIdx), -1)
+        cholC = jitterCholesky(G[:, missIdx])
+    elif calcVar and not isComplete:
+        # exact posterior from the covariance of the observed cells only
+        obsIdx = np.flatnonzero(mask.ravel())
+        [obsT, obsS] = np.divmod(obsIdx, nS)
+        KObs = sigmaF**2 * Kt[np.ix_(obsT, obsT)] * Ks[np.ix_(obsS, obsS)]
+        KObs[np.diag_indices_from(KObs)] += sigmaN**2
+        cholObs = jitterCholesky(KObs)
+
+    if blockSize is None:
+        blockSize = max(xQuery.shape[0], 1)
+    yPred = np.zeros(xQuery.shape[0])
+    yVar = np.zeros(xQuery.shape[0]) if calcVar else None
+    for start in range(0, xQuery.shape[0], blockSize):
+        xq = xQuery[start:start + blockSize, :]
+        ksq = kernelMatrix(xq[:, :2], xs, 1.0, L[:2], kerType)
+        ktq = temporalKernel(xq[:, 2], t, L[2], kerType)
+        # rows of sigmaF^2 * kt (x) ks, the cross covariance with every grid cell
+        KStar = sigmaF**2 * (ktq[:, :, np.newaxis] * ksq[:, np.newaxis, :]).reshape(xq.shape[0], -1)
+        yPred[start:start + blockSize] = KStar.dot(alpha.ravel()) + yMean
+        if basisFnDeg >= 0:
+            HStar = np.asarray(basisMatrix(xq, basisFnDeg))
+            yPred[start:start + blockSize] += HStar.T.dot(Beta)
+
+        if calcVar and (isComplete or isLowRank):
+            # KStar * K^-1 * KStar.T of the complete grid from the eigendecompositions
+            Ut = ktq.dot(Qt)
+            Us = ksq.dot(Qs)
+            quad = sigmaF**4 * np.sum((Ut**2).dot(invLam) * Us**2, axis=1)
+            if not isComplete:
+                Z = KStar.dot(G.T)
+                quad -= np.sum(Z * cho_solve((cholC, True), Z.T).T, axis=1)
+        elif calcVar:
+            # KStar * K^-1 * KStar.T of the observed cells
+            V = KStar[:, obsIdx]
+            quad = np.sum(V * cho_solve((cholObs, True), V.T).T, axis=1)
+        if calcVar:
+            var = sigmaF**2 - quad
+            if basisFnDeg >= 0:
+                R = HStar - invKH.reshape(nBasis, -1).dot(KStar.T)
+                var += np.sum(R * cho_solve((cholA, True), R), axis=0)
+            yVar[start:start + blockSize] = var
+
+    yPred = np.matrix(yPred).T
+    if calcVar:
+        yVar = np.matrix(yVar).T
+    return [yPred, yVar]
+
+
+# Temporal factor of the separable kernels, with unit variance
+def temporalKernel(t1, t2, Lt, kerType):
+    dt = np.abs(np.asarray(t1, dtype=float).ravel()[:, np.newaxis] - np.asarray(t2, dtype=float).ravel()[np.newaxis, :])
+    if kerType == "Exp":
+        return np.exp(-dt / float(Lt))
+    elif kerType == "SqExp":
+        return np.exp(-dt**2 / (2 * float(Lt)**2))
+    else:
+        raise ValueError('Unknown kernel type: ' + str(kerType))
+
+
+# Preconditioned conjugate gradient for a stack of right hand sides B (r x T x S arrays), each one with its own step sizes
+def maskedConjugateGradient(product, precondition, B, tol, maxIt):
+    X = np.zeros(B.shape)
+    R = B.copy()
+    Z = precondition(R)
+    P = Z.copy()
+    rz = np.sum(R * Z, axis=(1, 2))
+    bNorm = np.sqrt(np.sum(B**2, axis=(1, 2)))
+    for it in range(maxIt):
+        if np.all(np.sqrt(np.sum(R**2, axis=(1, 2))) <= tol * bNorm):
+            break
+        AP = product(P)
+        pAp = np.sum(P * AP, axis=(1, 2))
+        # right hand sides that already converged (or are zero) are not updated anymore
+        active = rz > 0
+        alpha = np.where(active, rz / np.where(active, pAp, 1.0), 0.0)
+        X += alpha[:, np.newaxis, np.newaxis] * P
+        R -= alpha[:, np.newaxis, np.newaxis] * AP
+        Z = precondition(R)
+        rzNew = np.sum(R * Z, axis=(1, 2))
+        beta = np.where(active, rzNew / np.where(active, rz, 1.0), 0.0)
+        P = Z + beta[:, np.newaxis, np.newaxis] * P
+        rz = rzNew
+    else:
+        print 'Masked conjugate gradient did not converge after ' + str(maxIt) + ' iterations'
+    return X
@@ -0,0 +1,55 @@
+import numpy as np
+from GPR import gpFactorize, gpPredictBlocks
+
+
+# Gaussian Process Regression of several outputs (PM2.5, PM10, temperature, ...) measured at the same training points.
+# The outputs are grouped by their hyperparameters and by the points they are observed at; every group is factorized once
+# and all its outputs are solved against the same Cholesky factor, so an extra output of a group only costs triangular solves.
+#
+# x: n x d training points, the union of the points of all the outputs
+# Y: n x m measurements, one column per output, NaN where an output has no measurement
+# hyperparameters: [sigmaF, L, sigmaN] of every output, with one length scale per column of x
+# Returns [yPred, yVar] as nQuery x m matrices, NaN for the outputs without any measurement
+def multiOutputGpRegression(x, Y, xQuery, hyperparameters, basisFnDeg, kerType='Exp', center=True, calcVar=True, blockSize=None):
+    x = np.asarray(x, dtype=float)
+    Y = np.array(Y, dtype=float)
+    xQuery = np.matrix(xQuery, dtype=float)
+    assert(Y.shape[0] == x.shape[0]), 'The measurements should have a row for every training point and a column for every output'
+    assert(len(hyperparameters) == Y.shape[1]), 'Every output needs its own hyperparameters'
+
+    nQuery = xQuery.shape[0]
+    yPred = np.nan * np.ones((nQuery, Y.shape[1]))
+    yVar = np.nan * np.ones((nQuery, Y.shape[1])) if calcVar else None
+    for [sigmaF, L, sigmaN, observed, outputs] in outputGroups(Y, hyperparameters):
+        if len(observed) == 0:
+            continue
+        model = gpFactorize(np.matrix(x[observed, :]), np.matrix(Y[np.ix_(observed, outputs)]), sigmaF, L, sigmaN, basisFnDeg, kerType, center)
+        start = 0
+        for block in gpPredictBlocks(model, xQuery, blockSize, calcVar):
+            end = start + block[0].shape[0]
+            yPred[start:end, outputs] = np.asarray(block[0])
+            if calcVar:
+                # the variance does not depend on the measurements, all the outputs of the group share it
+                yVar[start:end, outputs] = np.asarray(block[1])
+            start = end
+
+    yPred = np.matrix(yPred)
+    if calcVar:
+        yVar = np.matrix(yVar)
+    return [yPred, yVar]
+
+
+# Groups the outputs with the same hyperparameters and the same observed training points.
+# Returns [sigmaF, L, sigmaN, observed rows, output columns] for every group, in the order of the first output of each group.
+def outputGroups(Y, hyperparameters):
+    groups = []
+    groupOf = {}
+    for j in range(Y.shape[1]):
+        [sigmaF, L, sigmaN] = hyperparameters[j]
+        observed = ~np.isnan(Y[:, j])
+        key = (float(sigmaF), tuple(float(l) for l in L), float(sigmaN), observed.tobytes())
+        if key not in groupOf:
+            groupOf[key] = len(groups)
+            groups.append([sigmaF, list(L), sigmaN, np.flatnonzero(observed), []])
+        groups[groupOf[key]][4].append(j)
+    return groups
@@ -1,10 +1,11 @@
 import numpy as np
 from math import log, pi
-from numpy.linalg import matrix_rank, det
-from utility_tools import kerFunc, basisTerms, nchoosek, logdet
+from numpy.linalg import matrix_rank
+from scipy.linalg import cho_solve, solve_triangular
+from utility_tools import basisMatrix, jitterCholesky, kernelFromDifferences, pairwiseDifferences
 
 
-def marginalNegLL(x,y,L,sigmaF,sigmaN,optL,optSigmaF,optSigmaN,basisFnDeg,isARD,isSpatIsot,kerType='EXP',calcGrad=True):
+def marginalNegLL(x,y,L,sigmaF,sigmaN,optL,optSigmaF,optSigmaN,basisFnDeg,isARD,isSpatIsot,kerType='Exp',calcGrad=True,context=None):
 
     if isARD:
         assert(len(L)==x.shape[1]),'The number of length scales should be the same as the independent variables in ARD mode'
@@ -13,112 +14,113 @@ def marginalNegLL(x,y,L,sigmaF,sigmaN,optL,optSigmaF,optSigmaN,basisFnDeg,isARD,
 
     nObs = x.shape[0]
     nts = y.shape[1]
-
-    if basisFnDeg>=0:
-        nIvar  = x.shape[1]
-        nBasis = nchoosek(basisFnDeg+nIvar,basisFnDeg)
-        H      = np.matrix(np.zeros((nBasis,nObs)))
-
-    delta = np.matrix(np.identity(nObs))
-    K = np.matrix(np.zeros((nObs, nObs)))
+    nL = len(L)
     if not isARD:
         Lnew = [L[0] for i in range(x.shape[1])]
     else:
         Lnew = L
 
-    if calcGrad: # gradient is required to be calculated
-        nL = len(L);
-        dKdSF = np.matrix(np.zeros((nObs, nObs)))
-        dKdL = np.zeros((nObs,nObs,nL))
-        dKdSN = np.matrix(np.zeros((nObs, nObs)))
-    for i in range(nObs):
-        for j in range(nObs):
-            K[i,j] = kerFunc(x[i,:],x[j,:],sigmaF,Lnew,kerType) + sigmaN**2 * delta[i,j]
-            if calcGrad: # gradient is required to be calculated
-                if isARD:
-                    L3 = [Li**(-3) for Li in L]
-                    sum=0.0
-                    for l in range(len(Lnew)):
-                        sum = sum + ((x[i, l]-x[j, l])**2)/(2*float(Lnew[l])**2)
-                    if isSpatIsot:
-                        if optL:
-                            dKdL[i,j,0] = sigmaF**2 * np.exp(-sum) * (((x[i,0]-x[j,0])**(2)+(x[i,1]-x[j,1])**(2)) *L3[0])
-                            dKdL[i,j,1] = dKdL[i,j,0];
-                            for k in range(2,nL):
-                                dKdL[i,j,k] = sigmaF**2 * np.exp(-sum) * (((x[i,k]-x[j,k])**2)*L3[k])
-                        if optSigmaF:
-                            dKdSF[i,j] = 2*sigmaF * np.exp(-sum)
-                        if optSigmaN:
-                            dKdSN[i,j] = 2*sigmaN * delta[i,j]
-                    else:
-                        if optL:
-                            for l in range(len(L3)):
-                                dKdL[i,j,l] = sigmaF**2 * np.exp(-sum) * (x[i,l]-x[j,l])**(2)*L3[l]
-                        if optSigmaF:
-                            dKdSF[i,j] = 2*sigmaF * np.exp(-sum)
-                        if optSigmaN:
-                            dKdSN[i,j] = 2*sigmaN * delta[i,j]
-                else:
-                    d2=0.0
-                    for l in range(x.shape[1]):
-                        d2 = d2 + ((x[i, l]-x[j, l])**2)
-                    if optL:
-                        dKdL[i,j,0] = sigmaF**2 * np.exp(-d2/(2*L[0]**2)) * (d2/L[0]**3)
-                    if optSigmaF:
-                        dKdSF[i,j] = 2*sigmaF * np.exp(-d2/(2*L[0]**2))
-                    if optSigmaN:
-                        dKdSN[i,j] = 2*sigmaN * delta[i,j]
-        if basisFnDeg>=0:
-            H[:,i] = basisTerms(x[i,:],basisFnDeg,1, [])
-    
-    invK  = K.I
-    invKy = invK * y
+    # all the covariance matrices and their derivatives are built from the same coordinate differences,
+    # which only depend on the training points and can be shared by all the evaluations through the context
+    if context is None:
+        context = trainingContext(x, basisFnDeg)
+    D = context['D']
+    D2 = context['D2']
+    Kf = kernelFromDifferences(D, sigmaF, Lnew, kerType, D2)
+    K = Kf + sigmaN**2 * np.identity(nObs)
+
+    # K is factored once per evaluation, for all the columns of y
+    cholK = jitterCholesky(K)
+    del K
+    y = np.asarray(y)
+    invKy = cho_solve((cholK, True), y)
+    logdetK = 2 * np.sum(np.log(np.diag(cholK)))
 
+    NLL = 0.5 * (np.sum(y * invKy) + nts * logdetK + nts * nObs * log(2 * pi))
     if basisFnDeg>=0:
-        m = matrix_rank(H)
+        H = context['H']
+        m = context['m']
+        # W.T * W = A = H * K^-1 * H.T
+        W = solve_triangular(cholK, H.T, lower=True)
+        cholA = jitterCholesky(W.T.dot(W))
+        HinvKy = H.dot(invKy)
+        Beta = cho_solve((cholA, True), HinvKy)
+        logdetA = 2 * np.sum(np.log(np.diag(cholA)))
+        # y.T * C * y = (H * K^-1 * y).T * A^-1 * (H * K^-1 * y)
+        NLL = NLL - 0.5 * (np.sum(HinvKy * Beta) - nts * logdetA + nts * m * log(2 * pi))
 
+    if not calcGrad:
+        return NLL, None
+
+    # dNLL/dtheta = -0.5 * trace(M * dK/dtheta) for the symmetric matrix M below, the traces are calculated as sums of elementwise products
+    invK = cho_solve((cholK, True), np.identity(nObs))
     if basisFnDeg>=0:
-        invKH = invK * H.T
-        A = H * invKH
-        C = invKH * A.I * invKH.T
-        if calcGrad: # gradient is required to be calculated
-            invA = A.I
-            invAH = invA * H
-            HinvA = H.T * invA
-    if calcGrad: # gradient is required to be calculated
-        gradNLL = np.matrix(np.zeros((nL+2,1)))
-    NLL=0
-    for t in range(nts):
-        NLL = NLL + 0.5*(y[:,t].T*invKy[:,t] + logdet(K,True) + nObs*log(2*pi))
-        if basisFnDeg>=0:
-            NLL = NLL - 0.5*( y[:,t].T*C*y[:,t] - log(det(A)) + m*log(2*pi))
-        if calcGrad: # gradient is required to be calculated
-            term = invKy[:,t]*invKy[:,t].T-invK
-            if optL:
-                for j in range(nL):
-                    gradNLL[j,0] = gradNLL[j,0] - 0.5*np.trace(term*dKdL[:,:,j])
-                    if basisFnDeg>=0:
-                        gradNLL[j,0] = gradNLL[j, 0]\
-                        - basisFnGradTerms(invAH,HinvA,np.matrix(dKdL[:,:,j]),invKy[:,t],invKH,invA)
-            if optSigmaF:
-                gradNLL[nL,0] = gradNLL[nL,0] - 0.5*np.trace(term*dKdSF)
-                if basisFnDeg>=0:
-                    gradNLL[nL,0] = gradNLL[nL,0]\
-                    - basisFnGradTerms(invAH,HinvA,dKdSF,invKy[:,t],invKH,invA)
-            if optSigmaN:
-                gradNLL[nL+1,0] = gradNLL[nL+1,0] - 0.5*np.trace(term*dKdSN)
-                if basisFnDeg>=0:
-                    gradNLL[nL+1,0] = gradNLL[nL+1,0]\
-                    - basisFnGradTerms(invAH,HinvA,dKdSN,invKy[:,t],invKH,invA)
-    
+        invKH = solve_triangular(cholK.T, W, lower=False)
+        invA = cho_solve((cholA, True), np.identity(cholA.shape[0]))
+        resid = invKy - invKH.dot(Beta)
+        M = resid.dot(resid.T) - nts * (invK - invKH.dot(invA).dot(invKH.T))
+    else:
+        M = invKy.dot(invKy.T) - nts * invK
+    del invK
+
+    gradNLL = np.matrix(np.zeros((nL+2,1)))
+    if optL:
+        for j, dKdL in enumerate(lengthScaleDerivatives(D, D2, Kf, Lnew, kerType, isARD, isSpatIsot)):
+            gradNLL[j,0] = -0.5 * np.sum(M * dKdL)
+    if optSigmaF:
+        gradNLL[nL,0] = -0.5 * np.sum(M * (2 * Kf / sigmaF))
+    if optSigmaN:
+        gradNLL[nL+1,0] = -0.5 * 2 * sigmaN * np.trace(M)
+
     return NLL, gradNLL
 
-def basisFnGradTerms(invAH,HinvA,dKdTheta,invKy,invKH,invA):
-    bFnGrTerms = 0.5*(np.trace(invA*invKH.T*dKdTheta*invKH)\
-    - invKy.T * \
-    (dKdTheta*invKH*invAH\
-    - HinvA*invKH.T*dKdTheta*invKH*invAH
-    + HinvA*invKH.T*dKdTheta)*\
-    invKy)
-    
-    return bFnGrTerms    
+
+# Quantities of a training set that do not depend on the hyperparameters: the absolute and squared coordinate differences per dimension and the basis matrix H.
+# They are computed once per training set, so that every evaluation of marginalNegLL only pays for the kernel exponential and the factorization.
+def trainingContext(x, basisFnDeg):
+    D = pairwiseDifferences(x, x)
+    context = {'D': D, 'D2': [Di**2 for Di in D]}
+    if basisFnDeg>=0:
+        H = np.asarray(basisMatrix(x, basisFnDeg))
+        context['H'] = H
+        context['m'] = matrix_rank(H)
+    return context
+
+
+# Yields the derivative of the noise-free kernel matrix Kf with respect to each length scale in L (ARD) or to the shared length scale.
+# In the spatially isotropic case the first two length scales are tied, and both get the derivative with respect to the shared spatial length scale.
+def lengthScaleDerivatives(D, D2, Kf, L, kerType, isARD, isSpatIsot):
+    if kerType == "SqExp":
+        if not isARD:
+            yield Kf * sum(D2) / L[0]**3
+        elif isSpatIsot:
+            dKdLs = Kf * (D2[0] + D2[1]) / L[0]**3
+            yield dKdLs
+            yield dKdLs
+            for k in range(2, len(L)):
+                yield Kf * D2[k] / L[k]**3
+        else:
+            for k in range(len(L)):
+                yield Kf * D2[k] / L[k]**3
+    elif kerType == "Exp":
+        r = np.sqrt(D2[0] / L[0]**2 + D2[1] / L[1]**2)
+        if not isARD:
+            expo = r.copy()
+            for k in range(2, len(L)):
+                expo += D[k] / L[0]
+            yield Kf * expo / L[0]
+            return
+        if isSpatIsot:
+            dKdLs = Kf * r / L[0]
+            yield dKdLs
+            yield dKdLs
+        else:
+            # r is zero only where both spatial differences are zero, and there the derivative is zero as well
+            rInv = np.zeros(r.shape)
+            np.divide(1.0, r, out=rInv, where=r > 0)
+            for k in range(2):
+                yield Kf * rInv * D2[k] / L[k]**3
+        for k in range(2, len(L)):
+            yield Kf * D[k] / L[k]**2
+    else:
+        raise ValueError('Unknown kernel type: ' + str(kerType))
@@ -1,9 +1,11 @@
 import argparse
-import calculateEstimates
+import calendar
 import json
 import logging
 import logging.handlers as handlers
+import multiprocessing
 import os
+import signal
 import sys
 import time
 
@@ -20,6 +22,13 @@ logHandler.setLevel(logging.INFO)
 logHandler.setFormatter(formatter)
 LOGGER.addHandler(logHandler)
 
+# binned measurements of the whole backfill range, {'start': startDate, 'end': endDate, 'data': output of calculateEstimates.getTrainingData}.
+# They are loaded once by main before the workers are forked, and every batch takes its window from them.
+PRELOADED = None
+
+# seconds between two checks for an interrupt while the parent waits for the next finished batch
+RESULT_POLL_SECONDS = 1
+
 
 # getting the config file
 def getConfig(aPath, fileName):
@@ -33,6 +42,69 @@ def getConfig(aPath, fileName):
     sys.exit(1)
 
 
+# BLAS libraries read their number of threads when they are loaded, so it has to be set before numpy is imported
+def pinBlasThreads(nThreads):
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[variable] = str(nThreads)
+
+
+# Estimates one batch of timesteps from PRELOADED, task is [first upper estimation bound, last upper estimation bound, interval in seconds, config file name].
+# Returns [task, number of timesteps, seconds, error message or None], errors are reported instead of raised so that the other batches go on.
+# The batches never repeat, so they do not use the estimation cache, and every worker keeps its own state of the rolling mode.
+def runBatch(task):
+    [batchStart, batchEnd, intervalSeconds, configFile] = task
+    import calculateEstimates
+    start = time.time()
+    try:
+        calculateEstimates.main(['false', '--d', configFile, '-q', batchStart, '-b', batchEnd, '-i', str(intervalSeconds), '--nocache', '--statesuffix', multiprocessing.current_process().name], PRELOADED)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    nSlices = int((datetime.strptime(batchEnd, '%Y-%m-%dT%H:%M:%SZ') - datetime.strptime(batchStart, '%Y-%m-%dT%H:%M:%SZ')).total_seconds() // intervalSeconds) + 1
+    return [task, nSlices, time.time() - start, error]
+
+
+# Initializer of the worker processes. Ctrl-C only interrupts the parent, which then terminates the pool, and every worker logs the
+# estimation to its own file, since the rollover of a log file is not safe across processes.
+def initWorker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import calculateEstimates
+    for aHandler in list(calculateEstimates.LOGGER.handlers):
+        if isinstance(aHandler, logging.FileHandler):
+            calculateEstimates.LOGGER.removeHandler(aHandler)
+            aHandler.close()
+    workerHandler = handlers.RotatingFileHandler('cronPMEstimation_' + multiprocessing.current_process().name + '.log', maxBytes=5000000, backupCount=5)
+    workerHandler.setLevel(logging.INFO)
+    workerHandler.setFormatter(calculateEstimates.formatter)
+    calculateEstimates.LOGGER.addHandler(workerHandler)
+
+
+# Results of an imap iterator of a pool. Under Python 2 a wait without a timeout cannot be interrupted, so it waits
+# RESULT_POLL_SECONDS at a time and KeyboardInterrupt reaches the parent in between.
+def interruptibleResults(results):
+    while True:
+        try:
+            yield results.next(RESULT_POLL_SECONDS)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+# The checkpoint holds the batches that are done, as "first bound/last bound" keys, so that an interrupted backfill only runs the missing ones
+def loadCheckpoint(checkpointPath):
+    if not os.path.isfile(checkpointPath):
+        return set()
+    with open(checkpointPath, 'r') as checkpointFile:
+        return set(json.loads(checkpointFile.read()))
+
+
+def saveCheckpoint(checkpointPath, done):
+    with open(checkpointPath + '.tmp', 'w') as checkpointFile:
+        checkpointFile.write(json.dumps(sorted(done)))
+    os.rename(checkpointPath + '.tmp', checkpointPath)
+
+
 def main(args):
     debuggingConfigFile = 'modellingConfig_debugging.json'
 
@@ -40,6 +112,9 @@ def main(args):
     parser.add_argument("startQuerytime", help="start query time (UTC) for estimation with format: \%Y-\%m-\%dT\%H:\%M:\%SZ")
     parser.add_argument("endQuerytime", help="end query time (UTC) for estimation with format: \%Y-\%m-\%dT\%H:\%M:\%SZ")
     parser.add_argument("interval", help="interval until next estimate calculation in seconds")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="number of batches estimated in parallel")
+    parser.add_argument("-t", "--threads", type=int, help="BLAS threads of every process, by default the cores are shared among the processes")
+    parser.add_argument("-c", "--checkpoint", help="file of the batches that are done, an interrupted backfill with the same file resumes where it stopped")
 
     args = parser.parse_args(args)
 
@@ -57,22 +132,82 @@ def main(args):
     LOGGER.info('START upperEstimationBound timstep: %s', start_upperEstimationBound.strftime('%Y-%m-%dT%H:%M:%SZ'))
     LOGGER.info('END upperEstimationBound timstep: %s', end_upperEstimationBound.strftime('%Y-%m-%dT%H:%M:%SZ'))
 
-    while start_upperEstimationBound <= end_upperEstimationBound:
-        LOGGER.info('START timstep: %s', startQuerytime.strftime('%Y-%m-%dT%H:%M:%SZ'))
-
-        start = time.time()
-
-        calculateEstimates.main(['false', '--d', debuggingConfigFile, '-q', start_upperEstimationBound.strftime('%Y-%m-%dT%H:%M:%SZ')])
-
-        end = time.time()
-        diff = end - start
+    # number of consecutive timesteps estimated as one batch, with one data query and one factorization
+    batchSlices = modellingConfig.get('batchSlices', 12)
 
-        LOGGER.info('*********** Time to calculate estimate: {}'.format(diff))
-        LOGGER.info('Finished timestep: %s', startQuerytime.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    tasks = []
+    while start_upperEstimationBound <= end_upperEstimationBound:
+        batch_upperEstimationBound = min(start_upperEstimationBound + (batchSlices - 1) * interval, end_upperEstimationBound)
+        tasks.append([start_upperEstimationBound.strftime('%Y-%m-%dT%H:%M:%SZ'), batch_upperEstimationBound.strftime('%Y-%m-%dT%H:%M:%SZ'), int(interval.total_seconds()), debuggingConfigFile])
 
-        startQuerytime += interval
+        startQuerytime += batchSlices * interval
         start_upperEstimationBound = startQuerytime + timedelta(seconds=characteristicTimeLength)
 
+    checkpointPath = args.checkpoint
+    done = loadCheckpoint(checkpointPath) if checkpointPath else set()
+    todo = [task for task in tasks if task[0] + '/' + task[1] not in done]
+    LOGGER.info('%s of %s batches to estimate with %s processes', len(todo), len(tasks), args.processes)
+
+    # without pinning, every process would start one BLAS thread per core
+    nThreads = args.threads if args.threads else max(1, multiprocessing.cpu_count() // args.processes)
+    pinBlasThreads(nThreads)
+
+    # imported here, so that numpy is only loaded once the BLAS threads are pinned
+    import calculateEstimates
+
+    # the windows of all the batches are read from InfluxDB with one query of the whole range. A window cut from the preloaded bins is
+    # only the same as a query of the window when its bounds are on bin boundaries, otherwise every batch queries its own window.
+    global PRELOADED
+    binFrequency = modellingConfig['binFrequency']
+    windowBounds = [datetime.strptime(task[0], '%Y-%m-%dT%H:%M:%SZ') - timedelta(seconds=2 * characteristicTimeLength) for task in todo] + \
+                   [datetime.strptime(task[1], '%Y-%m-%dT%H:%M:%SZ') for task in todo]
+    if any(calendar.timegm(aBound.utctimetuple()) % binFrequency != 0 for aBound in windowBounds):
+        LOGGER.warning('the windows of the batches are not on bin boundaries of %s s, every batch queries its own window', binFrequency)
+    elif todo:
+        rangeStart = datetime.strptime(todo[0][0], '%Y-%m-%dT%H:%M:%SZ') - timedelta(seconds=2 * characteristicTimeLength)
+        rangeEnd = datetime.strptime(todo[-1][1], '%Y-%m-%dT%H:%M:%SZ')
+        [newPAirClient, newAirUClient, dbs] = calculateEstimates.getInfluxClientFactories(calculateEstimates.getConfig('../config/', 'config.json'))
+        bottomLeftCorner = {'lat': modellingConfig['bottomLeftCorner_LAT'], 'lng': modellingConfig['bottomLeftCorner_LONG']}
+        topRightCorner = {'lat': modellingConfig['topRightCorner_LAT'], 'lng': modellingConfig['topRightCorner_LONG']}
+        # the other layers of the multiOutput mode are loaded with the PM2.5
+        layers = [anOutput[0] for anOutput in calculateEstimates.multiOutputLayers(modellingConfig)]
+        loadStart = time.time()
+        PRELOADED = {'start': rangeStart, 'end': rangeEnd, 'data': calculateEstimates.getTrainingData(newPAirClient, newAirUClient, dbs, rangeStart, rangeEnd, bottomLeftCorner, topRightCorner, binFrequency, modellingConfig.get('queryThreads', 8), modellingConfig.get('queriesPerSource', 4), layers)}
+        LOGGER.info('loaded %s bins of %s sensors from %s to %s in %s s', len(PRELOADED['data'][3]), len(PRELOADED['data'][5]), todo[0][0], todo[-1][1], time.time() - loadStart)
+
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, initWorker)
+        results = interruptibleResults(pool.imap_unordered(runBatch, todo))
+    else:
+        pool = None
+        results = (runBatch(task) for task in todo)
+
+    start = time.time()
+    nDone = 0
+    nFailed = 0
+    try:
+        for [task, nSlices, seconds, error] in results:
+            if error is not None:
+                LOGGER.error('batch %s to %s failed after %s s: %s', task[0], task[1], seconds, error)
+                nFailed += 1
+                continue
+            nDone += nSlices
+            if checkpointPath:
+                done.add(task[0] + '/' + task[1])
+                saveCheckpoint(checkpointPath, done)
+            LOGGER.info('Finished batch %s to %s (%s timesteps) in %s s, %.2f timesteps per minute so far', task[0], task[1], nSlices, seconds, 60.0 * nDone / (time.time() - start))
+    except BaseException:
+        # an interrupted backfill stops its workers, the checkpoint already has every finished batch
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    LOGGER.info('*********** %s timesteps in %s s: %.2f timesteps per minute, %s failed batches', nDone, elapsed, 60.0 * nDone / elapsed if elapsed > 0 else 0.0, nFailed)
+
 
 if __name__ == '__main__':
     main(sys.argv[1:])
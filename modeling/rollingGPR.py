@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+from scipy.linalg import qr, solve_triangular
+from GPR import gpModel, gpPredictBlocks
+from utility_tools import jitterCholesky, kernelMatrix, longLat2Km
+
+
+# Rolling window Gaussian Process Regression: the Cholesky factor of the training covariance is kept on disk between the runs,
+# and when the window moves, the oldest time bins are dropped and the newest ones appended by updating the factor instead of refactorizing.
+# The training points are the observed cells of the time x sensor grid in time-major order, so the dropped rows are always the leading ones.
+# The factor is refactorized when the sensors, the hyperparameters or the observed cells of the shared bins change, after maxUpdates
+# incremental updates, or when it drifts from the covariance by more than driftTol (relative, checked on a few columns).
+#
+# lat_tr, long_tr: the position of each of the S sensors
+# binTimes: the T bin times, in hours since a fixed reference (the epoch)
+# y_tr: T x S measurements, NaN where a sensor has no measurement
+# xQuery: query points (lat, long, time), the time in hours since the same reference as binTimes
+# state: the state of the previous run (loadRollingState), or None
+# Returns [yPred, yVar, state, isIncremental]
+def rollingGpRegression(state, lat_tr, long_tr, binTimes, y_tr, xQuery, sigmaF, L, sigmaN, basisFnDeg, kerType='Exp', center=True, calcVar=True, blockSize=None, driftTol=1e-8, maxUpdates=100):
+    y_tr = np.array(y_tr, dtype=float)
+    mask = ~np.isnan(y_tr)
+    binTimes = np.asarray(binTimes, dtype=float).ravel()
+    sensors = np.column_stack((np.asarray(lat_tr, dtype=float), np.asarray(long_tr, dtype=float)))
+    hyper = np.array([sigmaF] + list(L) + [sigmaN, basisFnDeg], dtype=float)
+    assert(mask.shape == (len(binTimes), sensors.shape[0])), "The measurements should have a row for every bin and a column for every sensor!"
+
+    shift = windowShift(state, sensors, binTimes, mask, hyper)
+    isIncremental = shift is not None and state['nUpdates'] < maxUpdates
+    if isIncremental:
+        [nDropBins, nKeptBins] = shift
+        projection = state['projection']
+        x = state['x'][int(np.sum(state['mask'][:nDropBins])):, :]
+        xNew = gridPoints(sensors, binTimes[nKeptBins:], mask[nKeptBins:], projection)
+        cholK = choleskyDropLeading(state['cholK'], state['x'].shape[0] - x.shape[0])
+        if xNew.shape[0] > 0:
+            cholK = choleskyAppend(cholK, kernelMatrix(x, xNew, sigmaF, L, kerType), kernelMatrix(xNew, xNew, sigmaF, L, kerType) + sigmaN**2 * np.identity(xNew.shape[0]))
+            x = np.concatenate((x, xNew), axis=0)
+        nUpdates = state['nUpdates'] + 1
+        isIncremental = choleskyDrift(cholK, x, sigmaF, L, sigmaN, kerType) <= driftTol
+
+    if not isIncremental:
+        # the projection and the time reference are fixed at every full factorization, so that the kept rows stay valid
+        rows = np.nonzero(mask)
+        projection = np.array([sensors[rows[1], 1].min(), sensors[rows[1], 0].min(), sensors[rows[1], 0].mean(), binTimes[0]])
+        x = gridPoints(sensors, binTimes, mask, projection)
+        cholK = jitterCholesky(kernelMatrix(x, x, sigmaF, L, kerType) + sigmaN**2 * np.identity(x.shape[0]))
+        nUpdates = 0
+
+    model = gpModel(np.matrix(x), np.matrix(y_tr[mask]).T, cholK, sigmaF, L, basisFnDeg, kerType, center)
+    blocks = list(gpPredictBlocks(model, np.matrix(projectPoints(np.asarray(xQuery, dtype=float), projection)), blockSize, calcVar))
+    yPred = np.concatenate([block[0] for block in blocks], axis=0)
+    yVar = np.concatenate([block[1] for block in blocks], axis=0) if calcVar else None
+
+    state = {'x': x, 'cholK': cholK, 'mask': mask, 'binTimes': binTimes, 'sensors': sensors, 'hyper': hyper, 'projection': projection, 'nUpdates': nUpdates}
+    return [yPred, yVar, state, isIncremental]
+
+
+# Number of leading bins of the previous window to drop and number of its bins that are kept, or None if the factor cannot be updated
+def windowShift(state, sensors, binTimes, mask, hyper):
+    if state is None:
+        return None
+    if state['sensors'].shape != sensors.shape or not np.array_equal(state['sensors'], sensors) or not np.allclose(state['hyper'], hyper):
+        return None
+    nDropBins = int(np.searchsorted(state['binTimes'], binTimes[0] - 1e-9))
+    nKeptBins = len(state['binTimes']) - nDropBins
+    if nKeptBins == 0 or nKeptBins > len(binTimes) or not np.allclose(state['binTimes'][nDropBins:], binTimes[:nKeptBins]):
+        return None
+    # the factor only depends on which cells are observed, the measurements themselves may have changed
+    if not np.array_equal(state['mask'][nDropBins:], mask[:nKeptBins]):
+        return None
+    return [nDropBins, nKeptBins]
+
+
+# Training points (x km, y km, time) of the observed cells of the grid, in time-major order
+def gridPoints(sensors, binTimes, mask, projection):
+    rows = np.nonzero(mask)
+    return projectPoints(np.column_stack((sensors[rows[1], 0], sensors[rows[1], 1], binTimes[rows[0]])), projection)
+
+
+# Converts (lat, long, time) points with a fixed projection [longOrigin, latOrigin, meanLat, timeOrigin]
+def projectPoints(points, projection):
+    [xh, xv] = longLat2Km(points[:, 1], points[:, 0], projection[0], projection[1], projection[2])
+    return np.column_stack((np.asarray(xh).ravel(), np.asarray(xv).ravel(), points[:, 2] - projection[3]))
+
+
+# Factor of K[k:, k:] from the factor of K: with cholK = [[L11, 0], [L21, L22]] it is the factor of L22 * L22.T + L21 * L21.T,
+# calculated as a blocked rank-k update (the block columns are rotated with QR factorizations), in O(n^2 * k)
+def choleskyDropLeading(cholK, k, blockSize=None):
+    if k == 0:
+        return cholK
+    L22 = cholK[k:, k:].copy()
+    W = cholK[k:, :k].copy()
+    n = L22.shape[0]
+    if blockSize is None:
+        blockSize = max(k, 64)
+    for start in range(0, n, blockSize):
+        end = min(start + blockSize, n)
+        b = end - start
+        # [La, Wa] * Q = [La', 0] with La' lower triangular, from the QR factorization of [La, Wa].T
+        [Q, R] = qr(np.concatenate((L22[start:end, start:end], W[start:end, :]), axis=1).T)
+        signs = np.sign(np.diag(R))
+        signs[signs == 0] = 1
+        Q[:, :b] *= signs
+        L22[start:end, start:end] = (R[:b, :].T * signs)
+        W[start:end, :] = 0
+        if end < n:
+            rotated = np.concatenate((L22[end:, start:end], W[end:, :]), axis=1).dot(Q)
+            L22[end:, start:end] = rotated[:, :b]
+            W[end:, :] = rotated[:, b:]
+    return L22
+
+
+# Factor of [[K, B], [B.T, C]] from the lower factor of K
+def choleskyAppend(cholK, B, C):
+    S = solve_triangular(cholK, B, lower=True).T
+    n = cholK.shape[0]
+    m = C.shape[0]
+    cholNew = np.zeros((n + m, n + m))
+    cholNew[:n, :n] = cholK
+    cholNew[n:, :n] = S
+    cholNew[n:, n:] = jitterCholesky(C - S.dot(S.T))
+    return cholNew
+
+
+# Largest relative difference between cholK * cholK.T and the covariance, on a few columns spread over the matrix
+def choleskyDrift(cholK, x, sigmaF, L, sigmaN, kerType, nColumns=10):
+    cols = np.unique(np.linspace(0, x.shape[0] - 1, nColumns).astype(int))
+    K = kernelMatrix(x, x[cols, :], sigmaF, L, kerType)
+    K[cols, np.arange(len(cols))] += sigmaN**2
+    return np.abs(cholK.dot(cholK[cols, :].T) - K).max() / (sigmaF**2 + sigmaN**2)
+
+
+# Loads the state saved by saveRollingState, None if there is none
+def loadRollingState(path):
+    if not os.path.isfile(path):
+        return None
+    data = np.load(path)
+    state = dict((key, data[key]) for key in data.files)
+    data.close()
+    state['nUpdates'] = int(state['nUpdates'])
+    return state
+
+
+# Saves the state, through a temporary file so that an interrupted run never leaves a corrupted state behind
+def saveRollingState(path, state):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as stateFile:
+        np.savez(stateFile, **state)
+    os.rename(tmpPath, path)
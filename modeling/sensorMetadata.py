@@ -0,0 +1,32 @@
+# Metadata of the sensors (location and sensor model) for all the sensors of a measurement at once.
+# The latest value of every sensor comes from one LAST() query grouped by the "ID" tag, instead of one query per sensor;
+# the location measurements are then joined in memory by ID. Used by the data query of the modeling and by the monitoring.
+
+
+# Last row of a field for every sensor: {ID: row}, the row has 'time', 'last' and the extra columns.
+# condition is the WHERE clause of the query, e.g. "time >= '2018-01-01T00:00:00Z'", no restriction if None.
+def lastByID(client, measurement, field, extraColumns=[], condition=None):
+    query = 'SELECT LAST("' + field + '")' + ''.join(',"' + aColumn + '"' for aColumn in extraColumns) + ' FROM ' + measurement
+    if condition is not None:
+        query += ' WHERE ' + condition
+    query += ' GROUP BY "ID";'
+
+    lastRows = {}
+    for (name, tags), points in client.query(query).items():
+        for row in points:
+            lastRows[tags['ID']] = row
+    return lastRows
+
+
+# Last latitude, longitude and sensor model of every AirU sensor: {ID: {'latitude', 'longitude', 'sensorModel'}}.
+# A sensor is only listed when it has a latitude, its longitude is None when there is none.
+def sensorMetadata(client, latMeasurement, longMeasurement, condition=None):
+    lats = lastByID(client, latMeasurement, 'Latitude', ['SensorModel'], condition)
+    longs = lastByID(client, longMeasurement, 'Longitude', [], condition)
+
+    metadata = {}
+    for anID, row in lats.items():
+        metadata[anID] = {'latitude': row['last'],
+                          'longitude': longs.get(anID, {}).get('last'),
+                          'sensorModel': row.get('SensorModel')}
+    return metadata
@@ -0,0 +1,81 @@
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from utility_tools import basisMatrix, jitterCholesky, kernelMatrix
+
+
+# Gaussian Process Regression with the inducing point approximations FITC and VFE, the cost is O(n * M^2) for M inducing points.
+# The approximate prior covariance of the measurements is Q + Lambda, with Q = Kfu * Kuu^-1 * Kuf and
+#   FITC: Lambda = diag(K - Q) + sigmaN^2 * I
+#   VFE:  Lambda = sigmaN^2 * I
+# The basis functions get the GLS treatment of gpRegression, on the approximate covariance.
+#
+# Z: the M inducing points, with the same columns as x
+def sparseGpRegression(x, y, xQuery, Z, sigmaF, L, sigmaN, basisFnDeg, kerType='Exp', center=True, method='FITC', calcVar=True, blockSize=None):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+    xQuery = np.asarray(xQuery, dtype=float)
+    Z = np.asarray(Z, dtype=float)
+    yMean = 0.0
+    if basisFnDeg < 0 and center:
+        yMean = np.mean(y)
+        y = y - yMean
+
+    cholKuu = jitterCholesky(kernelMatrix(Z, Z, sigmaF, L, kerType))
+    # V.T * V = Q
+    V = solve_triangular(cholKuu, kernelMatrix(Z, x, sigmaF, L, kerType), lower=True)
+    if method == 'FITC':
+        lam = np.maximum(sigmaF**2 - np.sum(V**2, axis=0), 0) + sigmaN**2
+    elif method == 'VFE':
+        lam = sigmaN**2 * np.ones(x.shape[0])
+    else:
+        raise ValueError('Unknown sparse approximation: ' + str(method))
+
+    # (Q + Lambda)^-1 = Lambda^-1 - Lambda^-1 * V.T * Au^-1 * V * Lambda^-1, with Au = I + V * Lambda^-1 * V.T
+    VLam = V / lam
+    cholAu = jitterCholesky(np.identity(Z.shape[0]) + VLam.dot(V.T))
+    if basisFnDeg >= 0:
+        H = np.asarray(basisMatrix(x, basisFnDeg))
+        invCH = H.T / lam[:, np.newaxis] - VLam.T.dot(cho_solve((cholAu, True), VLam.dot(H.T)))
+        cholA = jitterCholesky(H.dot(invCH))
+        Beta = cho_solve((cholA, True), invCH.T.dot(y))
+        y = y - H.T.dot(Beta)
+        # kStar.T * (Q + Lambda)^-1 * H.T = VStar.T * wH, with kStar the approximate cross covariance VStar.T * V
+        wH = cho_solve((cholAu, True), VLam.dot(H.T))
+    wy = cho_solve((cholAu, True), VLam.dot(y))
+
+    nQuery = xQuery.shape[0]
+    if blockSize is None:
+        blockSize = max(nQuery, 1)
+    yPred = np.zeros(nQuery)
+    yVar = np.zeros(nQuery) if calcVar else None
+    for start in range(0, nQuery, blockSize):
+        xq = xQuery[start:start + blockSize, :]
+        VStar = solve_triangular(cholKuu, kernelMatrix(Z, xq, sigmaF, L, kerType), lower=True)
+        yPred[start:start + blockSize] = VStar.T.dot(wy) + yMean
+        if basisFnDeg >= 0:
+            HStar = np.asarray(basisMatrix(xq, basisFnDeg))
+            yPred[start:start + blockSize] += HStar.T.dot(Beta)
+        if calcVar:
+            W = solve_triangular(cholAu, VStar, lower=True)
+            var = sigmaF**2 - np.sum(VStar**2, axis=0) + np.sum(W**2, axis=0)
+            if basisFnDeg >= 0:
+                R = HStar - wH.T.dot(VStar)
+                var += np.sum(R * cho_solve((cholA, True), R), axis=0)
+            yVar[start:start + blockSize] = var
+
+    yPred = np.matrix(yPred).T
+    if calcVar:
+        yVar = np.matrix(yVar).T
+    return [yPred, yVar]
+
+
+# Lattice of inducing points, nLat x nLong points over the bounding box for each of the nTime time slices between timeStart and timeEnd
+def inducingLattice(bottomLeftCorner, topRightCorner, timeStart, timeEnd, nLat, nLong, nTime):
+    lats = np.linspace(bottomLeftCorner['lat'], topRightCorner['lat'], nLat)
+    lngs = np.linspace(bottomLeftCorner['lng'], topRightCorner['lng'], nLong)
+    if nTime == 1:
+        times = np.array([0.5 * (timeStart + timeEnd)])
+    else:
+        times = np.linspace(timeStart, timeEnd, nTime)
+    [T, LNG, LAT] = np.meshgrid(times, lngs, lats, indexing='ij')
+    return np.column_stack((LAT.ravel(), LNG.ravel(), T.ravel()))
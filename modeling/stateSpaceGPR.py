@@ -0,0 +1,132 @@
+import numpy as np
+from scipy.linalg import cho_solve
+from utility_tools import basisMatrix, jitterCholesky, kernelMatrix
+
+
+# Gaussian Process Regression for the "Exp" kernel with a Kalman filter and a Rauch-Tung-Striebel smoother over the time bins.
+# The temporal factor exp(-|dt|/Lt) is an Ornstein-Uhlenbeck process, so the values at the sensors follow
+#   f(t_k+1) = a * f(t_k) + w,  a = exp(-(t_k+1 - t_k)/Lt),  w ~ N(0, (1 - a^2) * Ks)
+# with Ks the spatial covariance of the sensors; the cost is linear in the number of time bins (O(T * S^3)).
+# The query points are conditioned on the sensor values of their own time, which is exact for a separable kernel.
+# The basis functions are passed through the same filter as extra data columns, which gives the exact GLS mean of gpRegression.
+#
+# xs: S x 2 spatial coordinates of the sensors
+# t: the T time bins
+# Y: T x S observations, NaN for the missing measurements
+# xQuery: nQuery x 3 query points (spatial coordinates and time)
+# L: the spatial length scales followed by the temporal length scale, [Ls, Ls, Lt]
+def stateSpaceGpRegression(xs, t, Y, xQuery, sigmaF, L, sigmaN, basisFnDeg, center=True, calcVar=True):
+    assert(len(L) == 3), 'The state space mode needs two spatial length scales and one temporal length scale'
+    xs = np.asarray(xs, dtype=float)
+    t = np.asarray(t, dtype=float).ravel()
+    Y = np.array(Y, dtype=float)
+    xQuery = np.asarray(xQuery, dtype=float)
+    nT = len(t)
+    nS = xs.shape[0]
+    assert(Y.shape == (nT, nS)), 'The observations should be a (number of time bins) x (number of sensors) matrix'
+
+    mask = ~np.isnan(Y)
+    yMean = 0.0
+    if basisFnDeg < 0 and center:
+        yMean = np.mean(Y[mask])
+        Y = Y - yMean
+
+    # the filter steps are the time bins and the query times, the query times only get a prediction
+    steps = np.union1d(t, xQuery[:, 2])
+    nSteps = len(steps)
+    binStep = np.searchsorted(steps, t)
+    nBasis = 0
+    if basisFnDeg >= 0:
+        nBasis = np.asarray(basisMatrix(np.zeros((1, 3)), basisFnDeg)).shape[0]
+    data = np.zeros((nSteps, nS, 1 + nBasis))
+    observed = np.zeros((nSteps, nS), dtype=bool)
+    data[binStep, :, 0] = np.where(mask, Y, 0.0)
+    observed[binStep, :] = mask
+    if nBasis > 0:
+        for i in range(nT):
+            data[binStep[i], :, 1:] = np.asarray(basisMatrix(np.column_stack((xs, np.repeat(t[i], nS))), basisFnDeg)).T
+
+    Ks = kernelMatrix(xs, xs, sigmaF, L[:2], 'Exp')
+    [mFilt, PFilt, mPred, PPred, gram] = kalmanFilter(data, observed, steps, Ks, L[2], sigmaN)
+
+    if nBasis > 0:
+        # data.T * Ky^-1 * data from the innovations gives A = H * Ky^-1 * H.T and H * Ky^-1 * y
+        cholA = jitterCholesky(gram[1:, 1:])
+        Beta = cho_solve((cholA, True), gram[1:, 0])
+
+    cholKs = jitterCholesky(Ks)
+    yPred = np.zeros(xQuery.shape[0])
+    yVar = np.zeros(xQuery.shape[0]) if calcVar else None
+    queryStep = np.searchsorted(steps, xQuery[:, 2])
+    for k, ms, Ps in rtsSmoother(mFilt, PFilt, mPred, PPred, steps, L[2], set(queryStep), calcVar):
+        idx = np.flatnonzero(queryStep == k)
+        xq = xQuery[idx, :]
+        ksq = kernelMatrix(xq[:, :2], xs, sigmaF, L[:2], 'Exp')
+        B = cho_solve((cholKs, True), ksq.T).T
+        if nBasis > 0:
+            HStar = np.asarray(basisMatrix(xq, basisFnDeg))
+            yPred[idx] = B.dot(ms[:, 0] - ms[:, 1:].dot(Beta)) + HStar.T.dot(Beta)
+        else:
+            yPred[idx] = B.dot(ms[:, 0]) + yMean
+        if calcVar:
+            var = np.sum(B.dot(Ps) * B, axis=1) + sigmaF**2 - np.sum(B * ksq, axis=1)
+            if nBasis > 0:
+                R = HStar - B.dot(ms[:, 1:]).T
+                var += np.sum(R * cho_solve((cholA, True), R), axis=0)
+            yVar[idx] = var
+
+    yPred = np.matrix(yPred).T
+    if calcVar:
+        yVar = np.matrix(yVar).T
+    return [yPred, yVar]
+
+
+# Forward pass over the steps for all the data columns at once (they share the gains).
+# Returns the filtered and predicted means and covariances of every step, and the Gram matrix data.T * Ky^-1 * data of the data columns.
+def kalmanFilter(data, observed, steps, Ks, Lt, sigmaN):
+    nSteps = data.shape[0]
+    mFilt, PFilt, mPred, PPred = [], [], [], []
+    gram = np.zeros((data.shape[2], data.shape[2]))
+    m = np.zeros(data.shape[1:])
+    for k in range(nSteps):
+        if k == 0:
+            mp = m
+            Pp = Ks
+        else:
+            a = np.exp(-(steps[k] - steps[k - 1]) / float(Lt))
+            mp = a * m
+            Pp = a**2 * P + (1 - a**2) * Ks
+        obs = observed[k]
+        if obs.any():
+            cholS = jitterCholesky(Pp[np.ix_(obs, obs)] + sigmaN**2 * np.identity(np.sum(obs)))
+            E = data[k, obs, :] - mp[obs, :]
+            invSE = cho_solve((cholS, True), E)
+            gram += E.T.dot(invSE)
+            m = mp + Pp[:, obs].dot(invSE)
+            P = Pp - Pp[:, obs].dot(cho_solve((cholS, True), Pp[obs, :]))
+        else:
+            m = mp
+            P = Pp
+        mFilt.append(m)
+        PFilt.append(P)
+        mPred.append(mp)
+        PPred.append(Pp)
+    return [mFilt, PFilt, mPred, PPred, gram]
+
+
+# Backward pass, yields (step, smoothed mean, smoothed covariance) for the steps in keep, starting from the last one
+def rtsSmoother(mFilt, PFilt, mPred, PPred, steps, Lt, keep, calcVar=True):
+    k = len(mFilt) - 1
+    ms = mFilt[k]
+    Ps = PFilt[k]
+    if k in keep:
+        yield k, ms, Ps
+    for k in range(len(mFilt) - 2, min(keep) - 1, -1):
+        a = np.exp(-(steps[k + 1] - steps[k]) / float(Lt))
+        # G = a * P_k * PPred_k+1^-1
+        G = a * cho_solve((jitterCholesky(PPred[k + 1]), True), PFilt[k]).T
+        ms = mFilt[k] + G.dot(ms - mPred[k + 1])
+        if calcVar:
+            Ps = PFilt[k] + G.dot(Ps - PPred[k + 1]).dot(G.T)
+        if k in keep:
+            yield k, ms, Ps
@@ -0,0 +1,81 @@
+import numpy as np
+from scipy.linalg import cho_solve
+from scipy.sparse import identity
+from scipy.sparse.linalg import splu
+from utility_tools import basisMatrix, jitterCholesky, taperedKernelMatrix
+
+# scikit-sparse is optional, without it the sparse factorization falls back to SuperLU
+try:
+    from sksparse.cholmod import cholesky as cholmodCholesky
+except ImportError:
+    cholmodCholesky = None
+
+# Default number of query points per block when calcVar is set: the variance solves K against a dense nObs x blockSize block
+VARIANCE_BLOCK_SIZE = 1000
+
+
+# Gaussian Process Regression with a covariance tapered by a compactly supported Wendland function of the spatial distance.
+# K and KStar only keep the pairs of points closer than taperRange (km), and K is factorized as a sparse matrix with a
+# fill-reducing ordering, so memory and solve time grow with the number of neighbors instead of the square of the network size.
+# The variance needs K^-1 KStar^T, which is dense, so with calcVar the queries are processed in blocks of VARIANCE_BLOCK_SIZE
+# points unless blockSize is given, and only the queries with a training point within taperRange are solved for.
+def taperedGpRegression(x, y, xQuery, sigmaF, L, sigmaN, basisFnDeg, taperRange, kerType='Exp', center=True, calcVar=True, blockSize=None):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+    xQuery = np.asarray(xQuery, dtype=float)
+    nObs = x.shape[0]
+    yMean = 0.0
+    if basisFnDeg < 0 and center:
+        yMean = np.mean(y)
+        y = y - yMean
+
+    K = taperedKernelMatrix(x, x, sigmaF, L, kerType, taperRange) + sigmaN**2 * identity(nObs, format='csc')
+    solve = sparseFactorization(K)
+    del K
+    invKy = solve(y)
+    if basisFnDeg >= 0:
+        H = np.asarray(basisMatrix(x, basisFnDeg))
+        invKH = solve(H.T)
+        cholA = jitterCholesky(H.dot(invKH))
+        Beta = cho_solve((cholA, True), H.dot(invKy))
+        alpha = invKy - invKH.dot(Beta)
+    else:
+        alpha = invKy
+
+    nQuery = xQuery.shape[0]
+    if blockSize is None:
+        blockSize = VARIANCE_BLOCK_SIZE if calcVar else max(nQuery, 1)
+    yPred = np.zeros(nQuery)
+    yVar = np.zeros(nQuery) if calcVar else None
+    for start in range(0, nQuery, blockSize):
+        xq = xQuery[start:start + blockSize, :]
+        KStar = taperedKernelMatrix(xq, x, sigmaF, L, kerType, taperRange)
+        yPred[start:start + blockSize] = KStar.dot(alpha) + yMean
+        if basisFnDeg >= 0:
+            HStar = np.asarray(basisMatrix(xq, basisFnDeg))
+            yPred[start:start + blockSize] += HStar.T.dot(Beta)
+        if calcVar:
+            var = np.full(xq.shape[0], float(sigmaF**2))
+            KRows = KStar.tocsr()
+            hasNeighbors = np.flatnonzero(np.diff(KRows.indptr))
+            if len(hasNeighbors) > 0:
+                KNear = KRows[hasNeighbors, :]
+                V = solve(KNear.T.toarray())
+                var[hasNeighbors] -= np.asarray(KNear.multiply(V.T).sum(axis=1)).ravel()
+            if basisFnDeg >= 0:
+                R = HStar - np.asarray(KStar.dot(invKH)).T
+                var += np.sum(R * cho_solve((cholA, True), R), axis=0)
+            yVar[start:start + blockSize] = var
+
+    yPred = np.matrix(yPred).T
+    if calcVar:
+        yVar = np.matrix(yVar).T
+    return [yPred, yVar]
+
+
+# Factorizes the sparse positive definite matrix K with a fill-reducing ordering and returns a function that solves K * X = B.
+# CHOLMOD is used when scikit-sparse is installed, otherwise SuperLU with a symmetric ordering and no pivoting (K is positive definite).
+def sparseFactorization(K):
+    if cholmodCholesky is not None:
+        return cholmodCholesky(K.tocsc())
+    return splu(K.tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0, options={'SymmetricMode': True}).solve
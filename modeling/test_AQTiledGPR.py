@@ -0,0 +1,32 @@
+import unittest
+
+import numpy as np
+from AQ_API import AQGPR, AQTiledGPR
+from benchmarkSparseGPR import benchmarkDataset
+
+
+# A single tile that covers all the query points and takes all the measurements has to reproduce the exact regression,
+# mean function (and the variance of its fit) included. Run from modeling/ with: python -m unittest test_AQTiledGPR
+class TestAQTiledGPR(unittest.TestCase):
+
+    def setUp(self):
+        bottomLeftCorner = {'lat': 40.5, 'lng': -112.1}
+        topRightCorner = {'lat': 40.8, 'lng': -111.6}
+        [self.xQuery, self.x_tr, self.y_tr] = benchmarkDataset(60, 6, 8, bottomLeftCorner, topRightCorner)
+        self.L0 = [2.0, 1.0]
+
+    def assertSingleTileIsExact(self, basisFnDeg):
+        [yPred, yVar] = AQGPR(self.xQuery, self.x_tr, self.y_tr, L0=self.L0, basisFnDeg=basisFnDeg)
+        [yPredTiled, yVarTiled] = AQTiledGPR(self.xQuery, self.x_tr, self.y_tr, L0=self.L0, basisFnDeg=basisFnDeg, tileSize=1000.0, minPoints=len(self.y_tr))
+        np.testing.assert_allclose(yPredTiled, yPred, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(yVarTiled, yVar, rtol=0, atol=1e-6)
+
+    def test_singleTileLinearMean(self):
+        self.assertSingleTileIsExact(1)
+
+    def test_singleTileConstantMean(self):
+        self.assertSingleTileIsExact(-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
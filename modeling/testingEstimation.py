@@ -17,7 +17,7 @@ from distutils.util import strtobool
 from influxdb import InfluxDBClient
 from pymongo import MongoClient
 from StringIO import StringIO
-from utility_tools import calibrate, datetime2Reltime, findMissings, removeMissings
+from utility_tools import calibrate, datetime2Reltime, epoch2Reltime, findMissings, removeMissings
 
 
 logger = logging.getLogger(__name__)
@@ -114,7 +114,7 @@ def getEstimate(purpleAirClient, airuClient, theDBs, nowMinusCHLT, numberOfLat,
     pm2p5_tr = pm2p5_tr.flatten().T
     lat_tr = np.tile(np.matrix(lat_tr).T, [nts, 1])
     long_tr = np.tile(np.matrix(long_tr).T, [nts, 1])
-    time_tr = datetime2Reltime(time_tr, min(time_tr))
+    time_tr = epoch2Reltime(time_tr, np.min(time_tr))
     time_tr = np.repeat(np.matrix(time_tr).T, nLats, axis=0)
 
     print('***** lat_tr *****')
@@ -2,8 +2,11 @@ import numpy as np
 # import os.path
 # import elevation
 from math import factorial, isnan
-from numpy.linalg import cholesky, det
+from numpy.linalg import cholesky, det, LinAlgError
+from itertools import chain
 from scipy.linalg import lu
+from scipy.sparse import csc_matrix
+from scipy.spatial import cKDTree
 # from scipy import interpolate
 # from osgeo import gdal
 # import scipy.io as sio
@@ -24,6 +27,58 @@ def kerFunc(x1, x2, sigmaF, L, kerType):
     return K
 
 
+# Absolute coordinate differences between all the rows of x1 and x2, one n1 x n2 array per independent variable
+def pairwiseDifferences(x1, x2):
+    x1 = np.asarray(x1, dtype=float)
+    x2 = np.asarray(x2, dtype=float)
+    return [np.abs(x1[:, i][:, np.newaxis] - x2[:, i][np.newaxis, :]) for i in range(x1.shape[1])]
+
+
+# Kernel block evaluated on the pairwise differences, gives the same values as kerFunc applied to every pair
+# D2 optionally holds the squared differences, when they are already available
+def kernelFromDifferences(D, sigmaF, L, kerType, D2=None):
+    nL = len(L)
+    if D2 is None:
+        D2 = [Di**2 for Di in D[:max(nL, 2)]]
+    if kerType == "SqExp":
+        expo = np.zeros(D[0].shape)
+        for i in range(nL):
+            expo += D2[i] / (2 * float(L[i])**2)
+    elif kerType == "Exp":
+        # the first two length scales are used for the spatial norm, a single length scale is shared by both
+        Ls = [L[0], L[0]] if nL == 1 else L[:2]
+        expo = np.sqrt(D2[0] / float(Ls[0])**2 + D2[1] / float(Ls[1])**2)
+        for i in range(2, nL):
+            expo += D[i] / float(L[i])
+    else:
+        raise ValueError('Unknown kernel type: ' + str(kerType))
+    return sigmaF**2 * np.exp(-expo)
+
+
+# Kernel Matrix between all the rows of x1 and x2 computed at once
+def kernelMatrix(x1, x2, sigmaF, L, kerType):
+    return kernelFromDifferences(pairwiseDifferences(x1, x2), sigmaF, L, kerType)
+
+
+# Wendland taper (1 - d/taperRange)^4 * (1 + 4 * d/taperRange), zero beyond taperRange and positive definite in up to 3 dimensions
+def wendlandTaper(d, taperRange):
+    r = np.minimum(d / float(taperRange), 1.0)
+    return (1 - r)**4 * (1 + 4 * r)
+
+
+# Kernel Matrix multiplied by the Wendland taper of the spatial distance (first two columns), as a sparse matrix:
+# only the pairs of points closer than taperRange are evaluated and stored
+def taperedKernelMatrix(x1, x2, sigmaF, L, kerType, taperRange):
+    x1 = np.asarray(x1, dtype=float)
+    x2 = np.asarray(x2, dtype=float)
+    neighbors = cKDTree(x1[:, :2]).query_ball_tree(cKDTree(x2[:, :2]), taperRange)
+    rows = np.repeat(np.arange(len(neighbors)), [len(nb) for nb in neighbors])
+    cols = np.fromiter(chain.from_iterable(neighbors), dtype=int, count=len(rows))
+    D = [np.abs(x1[rows, i] - x2[cols, i]) for i in range(x1.shape[1])]
+    values = kernelFromDifferences(D, sigmaF, L, kerType) * wendlandTaper(np.sqrt(D[0]**2 + D[1]**2), taperRange)
+    return csc_matrix((values, (rows, cols)), shape=(x1.shape[0], x2.shape[0]))
+
+
 # This calculates all the terms of a n-dimensional polynomial of degree d, recursively
 def basisTerms(x, remDeg, res, terms):
     if remDeg == 0 or x.size == 0:
@@ -36,6 +91,22 @@ def basisTerms(x, remDeg, res, terms):
         return terms
 
 
+# Same terms as basisTerms, calculated for all the rows of x at once; returns the nBasis x nRows matrix H
+def basisMatrix(x, basisFnDeg):
+    x = np.asarray(x, dtype=float)
+    return np.matrix(basisColumns(x, basisFnDeg, np.ones(x.shape[0]), []))
+
+
+def basisColumns(x, remDeg, res, terms):
+    if remDeg == 0 or x.shape[1] == 0:
+        return terms + [res]
+    else:
+        for i in range(remDeg + 1):
+            new_res = res * x[:, 0]**i
+            terms = basisColumns(x[:, 1:], remDeg - i, new_res, terms)
+        return terms
+
+
 # This calculates number of possible combinations of k objects chosen from n objects or n-choose-k
 def nchoosek(n, k):
     return factorial(n) / factorial(k) / factorial(n - k)
@@ -58,11 +129,29 @@ def logdet(M, isPosDef=False):
         return np.log(c) + np.sum(np.log(abs(du)))
 
 
-def longLat2Km(lng, lat, longOrigin, latOrigin):
+# Lower triangular Cholesky factor of a positive definite matrix; if the factorization fails, an increasing jitter is added to the diagonal
+def jitterCholesky(M, maxTries=6):
+    M = np.asarray(M)
+    try:
+        return cholesky(M)
+    except LinAlgError:
+        jitter = 1e-10 * np.mean(np.diag(M))
+        for i in range(maxTries):
+            try:
+                return cholesky(M + jitter * np.identity(M.shape[0]))
+            except LinAlgError:
+                jitter *= 10
+        raise LinAlgError('The matrix is not positive definite, even after adding a jitter of ' + str(jitter / 10) + ' to its diagonal.')
+
+
+# meanLat (degrees) fixes the latitude of the lat degrees to km conversion, by default it is the mean of lat
+def longLat2Km(lng, lat, longOrigin, latOrigin, meanLat=None):
     lng = np.matrix(lng, float)
     lat = np.matrix(lat, float)
     # converting the lat degrees to km
-    meanLat = lat.mean() * np.pi / 180.0
+    if meanLat is None:
+        meanLat = lat.mean()
+    meanLat = meanLat * np.pi / 180.0
     # minLat = lat.min()
     # latDiff = lat-minLat
     latDiff = lat - latOrigin
@@ -111,20 +200,18 @@ def longLat2Km(lng, lat, longOrigin, latOrigin):
 #     return (np.matrix(el).T)/1000.
 
 
+# Calibration of the sensor models, [gain, offset]; the readings of the other models are left as they are
+CALIBRATION = {'PMS5003': [0.7778, 2.6536],     # -67.0241*log(-0.00985*x+0.973658)
+               'PMS1003': [0.5431, 1.0607],     # -54.9149*log(-0.00765*x+0.981971)
+               'H1.1': [0.4528, 3.526]}
+
+
 # Calibrates sensor readings with respect to their model
 def calibrate(x, models):
     assert(np.shape(x)[1] == len(models)), 'You need to provide a model name for each column of the data matrix.'
-    xCalibrated = x.copy()
-    for i, model in enumerate(models):
-        if (model == 'PMS5003'):
-            xCalibrated[:, i] = 0.7778 * x[:, i] + 2.6536
-            # xCalibrated[:,i] = -67.0241*log(-0.00985*x[:,i]+0.973658)
-        elif (model == 'PMS1003'):
-            xCalibrated[:, i] = 0.5431 * x[:, i] + 1.0607
-        #   xCalibrated[:,i] = -54.9149*log(-0.00765*x[:,i]+0.981971)
-        elif (model == 'H1.1'):
-            xCalibrated[:, i] = 0.4528 * x[:, i] + 3.526
-    return xCalibrated
+    gains = np.array([CALIBRATION.get(model, [1.0, 0.0])[0] for model in models])
+    offsets = np.array([CALIBRATION.get(model, [1.0, 0.0])[1] for model in models])
+    return np.multiply(x, gains) + offsets
 
 
 # Converts datetime absolute format to a relative time format
@@ -136,34 +223,30 @@ def datetime2Reltime(times, refTime):
     return relTimes
 
 
-# Finds the missing values and marks interpolates the middle points and marks the rest as None
+# Converts epoch times in seconds to hours relative to refTime (epoch seconds)
+def epoch2Reltime(times, refTime):
+    return ((np.asarray(times, dtype=np.int64) - refTime) / 3600.0).tolist()
+
+
+# Finds the missing values and marks interpolates the middle points and marks the rest as NaN. Returns a float array, a missing value
+# is between the last valid one before it and the first valid one after it in its column.
 def findMissings(data):
-    nt = len(data)
-    nID = len(data[0])
-    for t in range(nt):
-        for id in range(nID):
-            if (data[t][id] <= 0) or (data[t][id] > 300):
-                data[t][id] = None
-
-    for j in range(nID):
-        i = 0
-        while i < nt:
-            if data[i][j] is None and i == 0:
-                while i < nt and data[i][j] is None:
-                    i += 1
-                    continue
-            elif data[i][j] is None:
-                z = i + 1
-                while z < nt and data[z][j] is None:
-                    z = z + 1
-                if z < nt:
-                    for k in range(i, z):
-                        data[k][j] = data[i - 1][j] + (k - (i - 1)) * (data[z][j] - data[i - 1][j]) / (z - (i - 1))
-                    i = z
-                    continue
-                else:
-                    break
-            i += 1
+    data = np.array(data, dtype=float)
+    with np.errstate(invalid='ignore'):
+        data[(data <= 0) | (data > 300)] = np.nan
+    nt = data.shape[0]
+
+    valid = ~np.isnan(data)
+    rows = np.repeat(np.arange(nt)[:, None], data.shape[1], axis=1)
+    before = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    after = np.minimum.accumulate(np.where(valid, rows, nt)[::-1], axis=0)[::-1]
+    gaps = ~valid & (before >= 0) & (after < nt)
+
+    k = rows[gaps]
+    i = before[gaps]
+    z = after[gaps]
+    j = np.nonzero(gaps)[1]
+    data[gaps] = data[i, j] + (k - i) * (data[z, j] - data[i, j]) / (z - i)
 
     return data
 
@@ -11,6 +11,9 @@ from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError
 from pymongo import MongoClient
 
+sys.path.append(sys.path[0] + '/../modeling')
+from sensorMetadata import lastByID, sensorMetadata  # noqa: E402
+
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
@@ -200,19 +203,18 @@ def runMonitoring(config, timeFrame, isSchool, borderBox, airUClient, airUMonito
                             + '%-10s' % '------------' + '\t' \
                             + '%-20s' % '------------' + '\n'
 
-    for anID in tmpIDs:
-        # last = airUClient.query('SELECT LAST(Latitude),"SensorModel" FROM ' +
-        #                         config['INFLUX_AIRU_LATITUDE_MEASUREMENT'] + ' WHERE ID=\'' + anID + '\' AND time >= now()-' + str(timeFrame) + 's;')
-        last = airUClient.query('SELECT LAST(Latitude),"SensorModel" FROM ' +
-                                config['INFLUX_AIRU_LATITUDE_MEASUREMENT'] + ' WHERE ID=\'' + anID + '\'')
+    # the last location, model and PM2.5 timestamp of all the sensors, with one query per measurement
+    metadata = sensorMetadata(airUClient, config['INFLUX_AIRU_LATITUDE_MEASUREMENT'], config['INFLUX_AIRU_LONGITUDE_MEASUREMENT'])
+    lastPM25 = lastByID(airUClient, config['INFLUX_AIRU_PM25_MEASUREMENT'], 'PM2.5')
 
+    for anID in tmpIDs:
         # get the email
         theEmail = 'unknown'
         if macs[anID]['sensorHolder'] in emails:
             theEmail = emails[macs[anID]['sensorHolder']]['email']
             theBatch = emails[macs[anID]['sensorHolder']]['batch']
 
-        if len(last) == 0:
+        if anID not in metadata:
             # LOGGER.info('never pushed data for ID: ' + anID + ' last Value: ' + last)
 
             theMessage = theMessage + '%-15s' % anID + '\t' \
@@ -227,18 +229,9 @@ def runMonitoring(config, timeFrame, isSchool, borderBox, airUClient, airUMonito
             appendToCSVFile(filePathSolution, [anID, int(theBatch), macs[anID]['sensorHolder'], theEmail, 'unknown', 'unknown', 'unknown', '-->OFFLINE', 'never been online'])
             continue
 
-        last = list(last.get_points())[0]
-        # LOGGER.info('ID: ' + anID + ' last Value: ' + last)
-
-        senModel = last['SensorModel']
-        lat = last['last']
-
-        # last = airUClient.query('SELECT LAST(Longitude),"SensorModel" FROM ' +
-        #                         config['INFLUX_AIRU_LONGITUDE_MEASUREMENT'] + ' WHERE ID=\'' + anID + '\' AND time >= now()-' + str(timeFrame) + 's;')
-        last = airUClient.query('SELECT LAST(Longitude),"SensorModel" FROM ' +
-                                config['INFLUX_AIRU_LONGITUDE_MEASUREMENT'] + ' WHERE ID=\'' + anID + '\'')
-        last = list(last.get_points())[0]
-        long = last['last']
+        senModel = metadata[anID]['sensorModel']
+        lat = metadata[anID]['latitude']
+        long = metadata[anID]['longitude']
 
 #        if lat is None or long is None:
 #            print ("Skipped sensor with ID:" + anID + " -> Latitude/Longitude information not available!")
@@ -297,11 +290,7 @@ def runMonitoring(config, timeFrame, isSchool, borderBox, airUClient, airUMonito
         nFine = nTotal - nFail - nOff
         status = ('-->OFFLINE' if (not result) else ('Failed' if res['PM2.5'] < 0 else 'online'))
 
-        theLastTimestamp = airUClient.query('SELECT LAST("PM2.5") FROM ' +
-                                            config['INFLUX_AIRU_PM25_MEASUREMENT'] + ' WHERE ID=\'' + anID + '\'')
-
-        timestamp = list(theLastTimestamp.get_points())
-        # print(timestamp)
+        timestamp = [lastPM25[anID]] if anID in lastPM25 else []
 
         theEmail = 'unknown'
         if macs[anID]['sensorHolder'] in emails: